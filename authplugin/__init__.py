@@ -1,24 +1,82 @@
 # coding=utf-8
 from __future__ import absolute_import
 
-import flask
-import requests
 import octoprint.plugin
+import time
+_IMPORT_STARTED = time.perf_counter() # This module's own load time, reported with the startup timings
+
+# requests and flask (and the modules built on requests) are imported where first
+# used, so loading the plugin, e.g. for OctoPrint's plugin list, doesn't pay for them
+import hashlib
 import json
 import os # Keep just in case needed later
+import socket
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .audit_log import AuditLog
+from .config import AuthConfig, DEFAULT_MATERIALS_URL_TEMPLATE
+from .decision_cache import DecisionCache
+from .gcode_estimator import FilamentEstimator, filament_usage
+from .materials_cache import MaterialsCache, FETCH_OK, FETCH_NOT_MODIFIED, FETCH_ERROR
+from .member_index import MemberIndex
+from .metrics import Metrics
+from .shared_store import SharedStore
+from .usage_outbox import UsageOutbox
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 # --- Plugin Class Definition (Ensuring all mixins) ---
 class PrintAuthPlugin(
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.SettingsPlugin,  # <-- For settings
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,   # <-- For templates
     octoprint.plugin.EventHandlerPlugin,
-    octoprint.plugin.SimpleApiPlugin
+    octoprint.plugin.SimpleApiPlugin,
+    octoprint.plugin.BlueprintPlugin
 ):
 
+    MAX_TRACKED_AUTH_JOBS = 20 # Finished async jobs kept for auth_status queries
+    # Commands that heat or move; a held job must not send one before it is authorized
+    HOLD_COMMANDS = frozenset(("G0", "G1", "G2", "G3", "G28", "G29", "M104", "M109", "M140", "M190", "M141", "M191"))
+
     def __init__(self):
-        self._session = None
+        self._api = None # Logged-in website session, created in on_startup
+        self._config = None # AuthConfig snapshot, rebuilt in on_startup and on_settings_save
+        self._shared = None # Cache shared with other instances on this host, None when disabled/unavailable
+        self._decision_cache = DecisionCache()
+        self._metrics = Metrics() # Always on, cheap enough for production
+        self._materials_cache = None # Needs the logger and data folder, created in on_startup
+        self._prepared_note = None # (job key, note text) built by the PrintStarted warm-up
+        self._auth_executor = None # Worker pool for async authenticate, created in on_startup
+        self._auth_jobs = OrderedDict() # request_id -> job dict
+        self._auth_jobs_lock = threading.Lock()
+        self._active_auth_job = None
+        self._member_index = None # Offline authorization, created in on_startup
+        self._usage_outbox = None
+        self._audit_log = None # Local record of decisions and material choices, created in on_startup
+        self._background_stop = threading.Event()
+        self._outbox_wakeup = threading.Event()
+        self._pending_usage = None # Authorized print waiting for its material choice
+        self._pending_usage_lock = threading.Lock()
+        self._preauth_tokens = OrderedDict() # token -> pre-authorization bound to user, file and printer
+        self._preauth_lock = threading.Lock()
+        self._preauth_running = {} # file_key -> pre-authorizations still being checked
+        self._print_awaiting_preauth = None # PrintStarted payload waiting for a running pre-authorization
+        self._hold_armed = False # Checked on every queued line, so it's the only thing the fast path reads
+        self._hold_lock = threading.Lock()
+        self._hold_active = False # We put the job on hold and must lift it
+        self._held_line = None # (cmd, tags) of a heat/move first line kept back from the printer
+        self._hold_timer = None
+        self._hold_authorized = False # Authenticate succeeded for the current job
+        self._filament_estimator = None # G-code fallback for missing analysis, created in on_startup
+        self._scan_executor = None # Single worker for upload-time G-code scans
+        self._io_executor = None # Upstream fetches run alongside the permission check
         # Cannot use self._logger here
 
     # -- SettingsPlugin --
@@ -33,13 +91,182 @@ class PrintAuthPlugin(
             tool_name="OctoPrintPrinter", # Default 'source' name for this printer
             api_method="octoprint_plugin", # Hardcoded info, shown in settings
             enable_material_prompt=True, # Default to enabled
-            material_tool_id="6046" # Default Material Tool ID, store as string
+            material_tool_id="6046", # Default Material Tool ID, store as string
+            materials_url_template=DEFAULT_MATERIALS_URL_TEMPLATE, # {tool_id} is replaced with the Material Tool ID
+            decision_cache_enabled=True, # Remember permission results between prints
+            decision_cache_granted_ttl=3600, # Seconds a granted result is reused
+            decision_cache_denied_ttl=300, # Seconds a denied result is reused
+            decision_cache_max_entries=256, # LRU bound on remembered members
+            materials_cache_max_age=3600, # Seconds before refetching materials when the server sends no ETag/Last-Modified
+            materials_revalidate_interval=300, # Minimum seconds between conditional materials revalidations
+            async_authenticate=False, # Return a request id at once and push the result to the frontend
+            auth_worker_threads=2, # Size of the worker pool used by async authenticate
+            session_max_age=21600, # Seconds before the website login is refreshed proactively
+            session_keepalive_interval=600, # Idle seconds between keep-alive requests, 0 disables
+            http_pool_size=4, # Pooled connections kept open to the API host
+            http_transport="requests", # "requests", or "httpx" (HTTP/2 capable, needs pip install httpx[http2])
+            http_connect_timeout=3.05, # Seconds to wait for a connection to the API host
+            http_read_timeout_min=2, # Lower bound for the adaptive read timeout
+            http_read_timeout_max=15, # Upper bound, also used until enough responses have been timed
+            circuit_failure_threshold=3, # Consecutive API failures before failing fast
+            circuit_reset_timeout=60, # Seconds to fail fast before probing the API again
+            preauthorize_enabled=False, # Ask for the email when a file is selected and check permission before printing
+            preauthorize_token_ttl=900, # Seconds a pre-authorization stays valid
+            hold_until_authorized=False, # Hold the job before its first heat/move command until authorized
+            hold_timeout=300, # Seconds a held job waits for authorization before it is cancelled
+            shared_cache_dir="", # Directory shared by all OctoPrint instances on this host; empty = per-instance caches
+            prometheus_enabled=False, # Serve metrics as Prometheus text at /plugin/print_auth_plugin/metrics
+            offline_auth_mode="off", # "off", "fallback" (only when the API is unreachable) or "primary" (local list first)
+            member_roster_url_template="", # JSON list of members holding {permission}; required for offline mode
+            member_sync_interval=3600, # Seconds between member list syncs
+            member_index_max_staleness=86400, # Offline approvals stop once the list is older than this
+            offline_fail_open=False, # Allow prints when the API is down and no usable member list exists
+            usage_flush_interval=60, # Seconds between usage outbox deliveries when idle
+            usage_batch_size=20, # Usage records sent per delivery batch
+            usage_retry_base_delay=30, # First retry delay after a failed delivery, doubled per failure
+            usage_retry_max_delay=3600, # Upper bound for the retry delay
+            usage_max_attempts=10, # A record the API rejects this many times is parked and no longer retried
+            audit_log_enabled=True, # Keep every decision and material choice in a local, queryable database
+            audit_log_max_size_mb=20, # Oldest records are removed beyond this size, 0 = unlimited
+            gcode_estimator_enabled=True, # Estimate filament from the G-code when OctoPrint's analysis is missing
+            filament_diameter=1.75, # mm, used to turn estimated length into volume
+            filament_density=1.24 # g/cm3 (PLA), used to turn estimated volume into weight
         )
 
+    def on_settings_save(self, data):
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        # Any settings change (permission name, URL, TTLs...) can make cached decisions wrong
+        self._configure_auth()
+        self._configure_api_session()
+        self._configure_decision_cache()
+        self._configure_materials_cache()
+        self._configure_audit_log()
+        cleared = self._decision_cache.invalidate()
+        self._logger.info(f"Settings saved, cleared {cleared} cached permission decision(s).")
+        if not self._hold_active and not self._printer.is_printing():
+            self._arm_hold() # Picks up hold_until_authorized for the next job
+
+    def _configure_api_session(self):
+        try:
+            self._api.configure(
+                self._settings.get_float(["session_max_age"]) or 0,
+                self._settings.get_float(["session_keepalive_interval"]) or 0,
+                self._settings.get_int(["http_pool_size"]) or 1
+            )
+            self._api.set_transport(self._settings.get(["http_transport"]) or "requests")
+            self._api.timeouts.configure(
+                self._settings.get_float(["http_connect_timeout"]) or 3.05,
+                self._settings.get_float(["http_read_timeout_min"]) or 2,
+                self._settings.get_float(["http_read_timeout_max"]) or 15
+            )
+            self._api.breaker.configure(
+                self._settings.get_int(["circuit_failure_threshold"]) or 1,
+                self._settings.get_float(["circuit_reset_timeout"]) or 60
+            )
+        except (ValueError, TypeError) as e:
+            self._logger.error(f"Invalid API session settings, keeping previous values: {e}")
+
+    def _configure_auth(self):
+        # Settings problems are reported here, once, instead of on every print
+        config = AuthConfig.from_settings(self._settings)
+        for problem in config.problems:
+            self._logger.error(problem)
+        self._config = config
+
+    def _get_login_credentials(self):
+        return self._settings.get(["login_url"]), self._settings.get(["username"]), self._settings.get(["password"])
+
+    def _configure_decision_cache(self):
+        try:
+            self._decision_cache.configure(
+                self._settings.get_int(["decision_cache_max_entries"]) or 0,
+                self._settings.get_float(["decision_cache_granted_ttl"]) or 0,
+                self._settings.get_float(["decision_cache_denied_ttl"]) or 0
+            )
+        except (ValueError, TypeError) as e:
+            self._logger.error(f"Invalid permission decision cache settings, keeping previous values: {e}")
+
+    def _configure_materials_cache(self):
+        try:
+            self._materials_cache.configure(
+                self._settings.get_float(["materials_cache_max_age"]) or 0,
+                self._settings.get_float(["materials_revalidate_interval"]) or 0
+            )
+        except (ValueError, TypeError) as e:
+            self._logger.error(f"Invalid materials cache settings, keeping previous values: {e}")
+
+    def _configure_audit_log(self):
+        try:
+            self._audit_log.configure((self._settings.get_float(["audit_log_max_size_mb"]) or 0) * 1024 * 1024)
+        except (ValueError, TypeError) as e:
+            self._logger.error(f"Invalid audit log settings, keeping previous values: {e}")
+
     # -- StartupPlugin --
     def on_startup(self, host, port):
-         self._logger.info(f"PrintAuthPlugin started. Tool: {self._settings.get(['tool_name'])}. Permission Check: {self._settings.get(['permission_name'])}. Material Prompt Enabled: {self._settings.get_boolean(['enable_material_prompt'])}. Material Tool ID: {self._settings.get(['material_tool_id'])}")
-         self._session = None # Ensure clean session on startup
+         started = time.perf_counter()
+         self._metrics.record_startup("import", _IMPORT_SECONDS)
+         with self._metrics.startup_phase("config"):
+             self._configure_auth()
+         config = self._config
+         self._logger.info(f"PrintAuthPlugin started. Tool: {config.tool_name}. Permission Check: {config.permission_name}. Material Prompt Enabled: {config.material_prompt_enabled}. Material Tool ID: {config.material_tool_id}")
+         with self._metrics.startup_phase("api_session"):
+             from .api_session import ApiSession # Brings in requests
+             self._shared = self._open_shared_store()
+             self._api = ApiSession(self._get_login_credentials, self._logger, # Ensure clean session on startup
+                                    on_circuit_change=self._on_circuit_change, metrics=self._metrics, shared=self._shared)
+             self._configure_api_session()
+             self._api.start_keepalive()
+         with self._metrics.startup_phase("caches"):
+             self._configure_decision_cache()
+             self._materials_cache = MaterialsCache(
+                 self._fetch_materials, self._logger,
+                 persist_path=os.path.join(self.get_plugin_data_folder(), "materials_cache.json"))
+             self._configure_materials_cache()
+             self._materials_cache.load()
+             self._member_index = MemberIndex(os.path.join(self.get_plugin_data_folder(), "member_index.db"), self._logger)
+             self._member_index.load()
+             self._usage_outbox = UsageOutbox(os.path.join(self.get_plugin_data_folder(), "usage_outbox.db"), self._logger)
+             released = self._usage_outbox.release_incomplete()
+             if released:
+                 self._logger.info(f"Releasing {released} usage record(s) of prints interrupted by a restart.")
+             self._filament_estimator = FilamentEstimator(os.path.join(self.get_plugin_data_folder(), "filament_estimates.json"), self._logger)
+             self._audit_log = AuditLog(os.path.join(self.get_plugin_data_folder(), "audit_log.db"), self._logger,
+                                        job_details=self._audit_job_details)
+             self._configure_audit_log()
+             self._audit_log.start()
+         with self._metrics.startup_phase("workers"):
+             self._auth_executor = ThreadPoolExecutor(max_workers=max(1, self._settings.get_int(["auth_worker_threads"]) or 1),
+                                                      thread_name_prefix="PrintAuthWorker")
+             self._scan_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PrintAuthGcodeScan")
+             # Separate from the auth pool so a permission check never waits for a free worker to fetch its materials
+             self._io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="PrintAuthIO")
+             self._background_stop.clear()
+             thread = threading.Thread(target=self._offline_sync_loop, name="PrintAuthOfflineSync")
+             thread.daemon = True
+             thread.start()
+             thread = threading.Thread(target=self._usage_flush_loop, name="PrintAuthUsageFlush")
+             thread.daemon = True
+             thread.start()
+             self._outbox_wakeup.set() # Deliver anything left over from before the restart
+             self._arm_hold()
+         self._metrics.record_startup("on_startup", time.perf_counter() - started)
+         timings = ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in self._metrics.startup_timings().items())
+         self._logger.info(f"PrintAuthPlugin startup timings: {timings}")
+
+    # -- ShutdownPlugin --
+    def on_shutdown(self):
+        self._background_stop.set()
+        self._outbox_wakeup.set()
+        if self._api:
+            self._api.close()
+        if self._auth_executor:
+            self._auth_executor.shutdown(wait=False)
+        if self._scan_executor:
+            self._scan_executor.shutdown(wait=False)
+        if self._io_executor:
+            self._io_executor.shutdown(wait=False)
+        if self._audit_log:
+            self._audit_log.stop() # Writes whatever is still queued
 
 
     # -- TemplatePlugin --
@@ -62,176 +289,686 @@ class PrintAuthPlugin(
     def on_event(self, event, payload):
         if event == "PrintStarted":
             self._logger.info("Print started event caught.")
-            # Check if essential settings are configured
-            api_user = self._settings.get(["username"])
-            api_pass = self._settings.get(["password"])
-            if not api_user or not api_pass:
-                self._logger.error("Plugin cannot authenticate: API username or password not configured in settings. Prompt will not be shown.")
-                return # Stop processing if not configured
+            self._on_print_started(payload)
+
+        elif event == "PrintCancelling":
+            self._drop_hold() # Otherwise the cancel itself waits behind the hold
+
+        elif event in ("PrintDone", "PrintFailed", "PrintCancelled", "Disconnected"):
+            with self._preauth_lock:
+                self._print_awaiting_preauth = None
+            # Still bill the print if the member closed the material dialog without choosing
+            if event != "Disconnected" and self._complete_pending_usage("unconfirmed"):
+                self._logger.info(f"Print ended ({event}) without a material choice, usage recorded as unconfirmed.")
+            self._arm_hold() # Drops anything still held and gates the next job
+
+        elif event == "FileAdded":
+            # Scan new uploads now so the estimate is ready (cached) by the time the print starts
+            if not self._settings.get_boolean(["gcode_estimator_enabled"]) or not self._scan_executor:
+                return
+            if (payload or {}).get("storage") != "local" or "gcode" not in (payload.get("type") or []):
+                return
+            self._scan_executor.submit(self._estimate_filament, "local", payload.get("path"))
+
+    def _on_print_started(self, payload):
+        # Check if essential settings are configured
+        if not self._config.credentials_configured:
+            self._logger.error("Plugin cannot authenticate: API username or password not configured in settings. Prompt will not be shown.")
+            return # Stop processing if not configured
+
+        file_key = ((payload or {}).get("origin"), (payload or {}).get("path"))
+        with self._preauth_lock:
+            waiting = bool(self._preauth_running.get(file_key))
+            if waiting:
+                self._print_awaiting_preauth = payload
+        if waiting:
+            # The member already entered their email for this file; don't ask again
+            self._logger.info(f"Pre-authorization for {file_key[1]} is still being checked, prompting only if it fails.")
+            return
+
+        preauthorized = self._consume_preauthorization(payload)
+        if preauthorized:
+            self._start_preauthorized_print(preauthorized)
+            return
+
+        self._logger.info("Settings OK, sending prompt message to frontend.")
+        # The breaker state lets the frontend warn right away when the auth service is down
+        self._plugin_manager.send_plugin_message("print_auth_plugin", {"prompt": True, "service": self._api.breaker.snapshot()})
 
-            self._logger.info("Settings OK, sending prompt message to frontend.")
-            self._plugin_manager.send_plugin_message("print_auth_plugin", {"prompt": True})
+        # Do the email-independent work while the member is still typing
+        self._prepared_note = None
+        thread = threading.Thread(target=self._warm_up_authentication, name="PrintAuthWarmUp")
+        thread.daemon = True
+        thread.start()
+
+    # -- PrintStarted Warm-Up --
+    def _warm_up_authentication(self):
+        # Login, job note and materials don't depend on the member's email, so they are
+        # prepared here and authenticate only has to do the per-email permission GET.
+        try:
+            session_error = self._ensure_session()
+            if session_error:
+                self._logger.warning(f"Warm-up login failed, authenticate will retry: {session_error.get('message')}")
+
+            job_info = self._printer.get_current_job()
+            job_key = self._current_job_key(job_info)
+            if job_key:
+                self._prepared_note = (job_key, self._build_job_note(job_info))
+
+            config = self._config
+            if config.material_prompt_enabled and config.material_tool_id and not session_error:
+                self.fetch_materials(config.material_tool_id) # Loads the cache, or revalidates it in the background
+            self._logger.info("Authentication warm-up complete.")
+        except Exception as e:
+            self._logger.error(f"Unexpected error during authentication warm-up: {e}", exc_info=True)
 
     # -- SimpleApiPlugin --
     def get_api_commands(self):
         # Define commands callable from JS
         return dict(
             authenticate=["email"],
-            confirm_material=["choice"]
+            confirm_material=["choice"],
+            clear_auth_cache=[],
+            auth_status=[],
+            preauthorize=["email"],
+            service_status=[],
+            get_metrics=[],
+            usage_by_member=[],
+            usage_by_file=[],
+            audit_decisions=[]
         )
 
     def on_api_command(self, command, data):
+        import flask
         # --- Authenticate Command ---
         if command == "authenticate":
             email = data.get("email")
             if not email:
                 return flask.jsonify(success=False, message="Email missing"), 400
 
-            self._logger.info(f"Attempting permission check via API command for email: {email}")
-
-            # --- Construct Note ---
-            note_text = "File: N/A, Filament: N/A" # Default note
-            try:
-                job_info = self._printer.get_current_job()
-                filename = "N/A"; filament_str = "N/A"
-                if job_info and job_info.get("file", {}).get("path"):
-                    file_path = job_info["file"]["path"]; file_origin = job_info["file"]["origin"]
-                    filename = job_info["file"].get("display", file_path)
-                    self._logger.info(f"Current job: {filename} (origin: {file_origin})")
-                    metadata = self._file_manager.get_metadata(file_origin, file_path)
-                    filament_data = metadata.get("analysis", {}).get("filament", {})
-                    if filament_data:
-                        usage_parts = []
-                        # Check modern tool-specific format first
-                        tool_usage = next(iter(filament_data.values()), None) if filament_data and isinstance(list(filament_data.values())[0], dict) else None
-                        if tool_usage:
-                             if tool_usage.get("length"): usage_parts.append(f"{tool_usage['length']:.1f}mm")
-                             if tool_usage.get("volume"): usage_parts.append(f"{tool_usage['volume']:.1f}cm3")
-                        else: # Fallback for older format
-                             if filament_data.get("length"): usage_parts.append(f"{filament_data['length']:.1f}mm")
-                             if filament_data.get("volume"): usage_parts.append(f"{filament_data['volume']:.1f}cm3")
-                        if usage_parts: filament_str = ' / '.join(usage_parts)
-                        else: self._logger.info("Filament usage data present but no length/volume found.")
-                    else:
-                         self._logger.info("No filament analysis data found in metadata.")
-                else:
-                    self._logger.warning("Could not get current job info to include in note.")
-
-                note_text = f"File: {filename}, Filament: {filament_str}"
-                self._logger.info(f"Generated note for API: {note_text}")
-            except Exception as e_note:
-                self._logger.error(f"Error generating note: {e_note}", exc_info=True)
-            # --- End Construct Note ---
-
-            # --- Call Authentication Logic ---
-            result = {"success": False, "message": "Authentication failed by default."}
-            try:
-                 result = self.handle_authentication(email, note=note_text) # Pass the detailed note
-
-                 # Check result and decide if print should be cancelled
-                 is_permission_failure = not result.get("success", False) and \
-                                         ("permission denied" in result.get("message","").lower() or \
-                                          "user not found" in result.get("message","").lower() or \
-                                          "lacks required permission" in result.get("message","").lower() or \
-                                          "not granted" in result.get("message","").lower())
-
-                 if not result.get("success", False):
-                      if is_permission_failure:
-                          self._logger.warning(f"Permission check failed for {email}. Canceling print. Reason: {result.get('message')}")
-                          self._printer.cancel_print()
-                          result["message"] += ". Print canceled."
-                      else: # Login, Network, or Settings Error
-                           self._logger.error(f"Authentication failed due to server/login/network/settings issue for {email}: {result.get('message')}")
-                           # Add advice for user in message already includes "notify staff" if login/network
-                           # result["message"] += ". Please notify staff." # Maybe redundant
-                 else:
-                      # Success case: message includes name, potentially materials list
-                      self._logger.info(f"Authentication/Permission check successful for {email}. Materials fetched (if enabled).")
-                      # Don't automatically proceed print here, wait for confirm_material if materials included
-
-            except Exception as e:
-                 # Catch unexpected errors during handle_authentication call
-                 self._logger.error(f"Unhandled exception during handle_authentication call for {email}: {e}", exc_info=True)
-                 self._printer.cancel_print() # Cancel on unexpected error
-                 result = {"success": False, "message": f"Server error during authentication. Print canceled. {e}"}
+            if self._settings.get_boolean(["async_authenticate"]):
+                # Answer right away; the outcome is pushed to the frontend as a plugin message
+                job, is_duplicate = self._submit_authentication(email)
+                return flask.jsonify(success=True, pending=True, request_id=job["request_id"], duplicate=is_duplicate,
+                                     message="Authentication already in progress." if is_duplicate else "Authentication in progress.")
 
             # Return the result (including name/materials if successful) to JS
+            with self._metrics.time("time_to_modal"):
+                result = self._run_authentication(email)
             return flask.jsonify(**result)
-            # --- End Call Authentication Logic ---
+
+
+        # --- Preauthorize Command ---
+        elif command == "preauthorize":
+            email = data.get("email")
+            if not email:
+                return flask.jsonify(success=False, message="Email missing"), 400
+            if not self._settings.get_boolean(["preauthorize_enabled"]):
+                return flask.jsonify(success=False, message="Pre-authorization is disabled."), 400
+            if not self._config.credentials_configured:
+                return flask.jsonify(success=False, message="Plugin settings error: API credentials not configured."), 400
+            file_key = (data.get("origin"), data.get("path")) if data.get("path") else self._current_job_key(self._printer.get_current_job())
+            if not file_key:
+                return flask.jsonify(success=False, message="No file selected."), 400
+            token = self._submit_preauthorization(email, file_key, self._current_user_name())
+            return flask.jsonify(success=True, pending=True, token=token, message="Checking permission for this file.")
 
         # --- Confirm Material Command ---
         elif command == "confirm_material":
             choice = data.get("choice")
             self._logger.info(f"Received material confirmation choice from frontend: '{choice}'")
             if choice in ["paid", "own_material"]:
-                # TODO: Add actual print resume logic if pausing is implemented
-                self._logger.info("Acknowledging choice. TODO: Add logic to actually resume/confirm print start if it was paused.")
-                # For now, just return success. The print likely continued already.
-                return flask.jsonify(success=True, message=f"Choice '{choice}' acknowledged. Print starting/continuing.")
+                if not self._complete_pending_usage(choice):
+                    self._logger.warning(f"Material choice '{choice}' received but no authorized print is waiting for one.")
+                if self._hold_armed and not self._hold_authorized:
+                    # A material choice alone must not start a held job
+                    return flask.jsonify(success=False, message="Print is not authorized yet."), 409
+                resumed = self._release_hold("material confirmed")
+                return flask.jsonify(success=True, message=f"Choice '{choice}' acknowledged. " + ("Print resuming." if resumed else "Print starting/continuing."))
             else:
                 self._logger.warning(f"Received invalid material choice: {choice}")
                 return flask.jsonify(success=False, message=f"Invalid choice received: {choice}"), 400
 
+        # --- Clear Auth Cache Command ---
+        elif command == "clear_auth_cache":
+            cleared = self._decision_cache.invalidate(data.get("email"))
+            if self._shared: # Other instances must not keep answering from the shared copy
+                if data.get("email"):
+                    self._shared.delete(key=self._shared_decision_key(data.get("email"), self._config.permission_name))
+                else:
+                    self._shared.delete(prefix="decision:")
+            self._logger.info(f"Cleared {cleared} cached permission decision(s) on request.")
+            return flask.jsonify(success=True, cleared=cleared, message=f"Cleared {cleared} cached permission decision(s).")
+
+        # --- Auth Status Command ---
+        elif command == "auth_status":
+            # Lets a reconnecting client pick up the outcome of an async authenticate it missed
+            status = self._get_auth_job_status(data.get("request_id"))
+            if status is None:
+                return flask.jsonify(success=False, message="No such authentication request."), 404
+            return flask.jsonify(success=True, **status)
+
+        # --- Metrics Command ---
+        elif command == "get_metrics":
+            if data.get("reset"):
+                self._metrics.reset()
+            return flask.jsonify(success=True, **self._metrics.snapshot())
+
+        # --- Service Status Command ---
+        elif command == "service_status":
+            return flask.jsonify(success=True, **self._get_service_status())
+
+        # --- Audit Log Query Commands ---
+        # Optional since/until (epoch seconds, default: this calendar month), tool, email, file, limit, offset
+        elif command in ("usage_by_member", "usage_by_file", "audit_decisions"):
+            if not self._can_read_audit_log():
+                return flask.jsonify(success=False, message="Admin rights required to read the audit log."), 403
+            try:
+                return flask.jsonify(success=True, **self._query_audit_log(command, data))
+            except (ValueError, TypeError) as e:
+                return flask.jsonify(success=False, message=f"Invalid query: {e}"), 400
+            except sqlite3.Error as e:
+                self._logger.error(f"Audit log query failed: {e}")
+                return flask.jsonify(success=False, message="Audit log unavailable."), 500
+
         # --- Unknown Command ---
         else:
             self._logger.warning(f"Received unknown API command: {command}")
             return flask.make_response(f"Unknown command: {command}", 400)
 
 
-    # -- Authentication Logic (Uses Settings) --
-    def handle_authentication(self, email, note="N/A"):
-        # Ensure session exists or login
-        if not self._session:
-            self._logger.info("No active session, attempting API login.")
-            login_result, login_message = self.login_to_api()
-            if login_result is None: # Network error during login
-                return dict(success=False, message=login_message)
-            if not login_result: # Login credentials failed
-                return dict(success=False, message=login_message)
-            # If login_result is True, proceed
-
-        # --- Get values from Settings ---
-        perm_check_url_template = self._settings.get(["permission_check_url_template"])
-        req_permission_name = self._settings.get(["permission_name"])
-        tool_name = self._settings.get(["tool_name"])
-        api_method = self._settings.get(["api_method"])
-        material_prompt_enabled = self._settings.get_boolean(["enable_material_prompt"])
-        material_tool_id_str = self._settings.get(["material_tool_id"])
-        # --- End Get values from Settings ---
-
-        # Validate essential settings needed BEFORE API call
-        if not all([perm_check_url_template, req_permission_name, tool_name, api_method]):
-            self._logger.error("Required settings are not fully configured (URL Template, Permission Name, Tool Name).")
-            return dict(success=False, message="Plugin settings error: Core API/Permission settings missing.")
-
-        # Validate Material Tool ID *if* material prompt is enabled
-        material_tool_id = None
-        if material_prompt_enabled:
-            if not material_tool_id_str:
-                self._logger.error("Material prompt enabled, but Material Tool ID setting is empty.")
-                return dict(success=False, message="Plugin settings error: Material Tool ID missing.")
-            try:
-                material_tool_id = int(material_tool_id_str)
-                if material_tool_id <= 0: raise ValueError("Tool ID must be positive")
-            except (ValueError, TypeError):
-                 self._logger.error(f"Invalid Material Tool ID configured: '{material_tool_id_str}'. Must be a positive number.")
-                 return dict(success=False, message="Plugin settings error: Invalid Material Tool ID.")
+    # -- BlueprintPlugin (Prometheus metrics) --
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_prometheus_metrics(self):
+        # Protected like every plugin blueprint, so scrapers pass an API key (X-Api-Key header)
+        import flask
+        if not self._settings.get_boolean(["prometheus_enabled"]):
+            flask.abort(404)
+        return flask.Response(self._metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
 
-        # Construct URL
+    def is_blueprint_csrf_protected(self):
+        return True
+
+    # -- Shared Cache --
+    def _open_shared_store(self):
+        directory = (self._settings.get(["shared_cache_dir"]) or "").strip()
+        if not directory:
+            return None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            store = SharedStore(directory, self._logger, owner=f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+            self._logger.info(f"Using shared cache {store.path}")
+            return store
+        except (OSError, sqlite3.Error) as e:
+            self._logger.warning(f"Shared cache in {directory} unavailable, using per-instance caches: {e}")
+            return None
+
+    def _shared_decision_key(self, email, permission_name):
+        # Hashed like the member index; the URL template keeps differently configured instances apart
+        raw = f"{DecisionCache.normalize_email(email)}|{permission_name}|{self._config.permission_check_url_template}"
+        return "decision:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # -- Audit Log --
+    def _audit_decision(self, email, result, kind, source, job=None, print_id=None):
+        # Queued for the audit writer thread, so this costs a dict and a queue put
+        if self._audit_log and self._config.audit_enabled:
+            self._audit_log.record_decision(email, self._config.tool_name, kind, result.get("success"), source,
+                                            result.get("message"), job, print_id)
+
+    def _audit_job_details(self, origin, path):
+        # Filament figures for an audit record; runs on the audit writer thread
         try:
-            safe_email = requests.utils.quote(email); safe_permission = requests.utils.quote(req_permission_name)
-            api_url = perm_check_url_template.format(email=safe_email, permission=safe_permission)
+            filament = self._job_filament(origin, path)
         except Exception as e:
-            self._logger.error(f"Error formatting permission check URL: {e}", exc_info=True)
-            return dict(success=False, message="Plugin settings error: Permission URL template invalid.")
+            self._logger.warning(f"Could not read filament usage of {path} for the audit log: {e}")
+            return None
+        if not filament:
+            return None
+        weight = filament["weight"]
+        if weight is None and filament["volume"]:
+            weight = filament["volume"] * (self._settings.get_float(["filament_density"]) or 1.24)
+        return dict(filament_mm=filament["length"], filament_g=weight)
+
+    def _can_read_audit_log(self):
+        # The audit log lists members' emails and usage
+        from octoprint.access.permissions import Permissions
+        return Permissions.ADMIN.can()
+
+    def _query_audit_log(self, command, data):
+        since, until = data.get("since"), data.get("until")
+        if since is None and until is None:
+            now = time.localtime() # Default to the current calendar month
+            since = time.mktime((now.tm_year, now.tm_mon, 1, 0, 0, 0, 0, 0, -1))
+        query = dict(since=since, until=until, tool=data.get("tool"), email=data.get("email"),
+                     limit=data.get("limit"), offset=data.get("offset"))
+        if command == "usage_by_member":
+            return self._audit_log.usage_by_member(**query)
+        if command == "usage_by_file":
+            return self._audit_log.usage_by_file(**query)
+        return self._audit_log.decisions(file=data.get("file"), **query)
+
+    # -- Upstream Service Status --
+    def _on_circuit_change(self, snapshot):
+        self._plugin_manager.send_plugin_message(self._identifier, {"service_status": snapshot})
+
+    def _get_service_status(self):
+        status = self._api.breaker.snapshot()
+        connect_timeout, read_timeout = self._api.timeouts.current()
+        status.update(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                      latency_p95=self._api.timeouts.percentile(0.95), logged_in=self._api.logged_in)
+        return status
+
+    # -- Job Note Construction --
+    def _current_job_key(self, job_info):
+        file_info = (job_info or {}).get("file") or {}
+        if not file_info.get("path"): return None
+        return (file_info.get("origin"), file_info.get("path"))
+
+    def _get_job_note(self):
+        job_info = self._printer.get_current_job()
+        job_key = self._current_job_key(job_info)
+        prepared = self._prepared_note
+        if job_key and prepared and prepared[0] == job_key:
+            self._logger.info(f"Using prepared note for API: {prepared[1]}")
+            return prepared[1]
+        # The warm-up hasn't finished: no G-code scan here, the usage record fills in the estimate later
+        return self._build_job_note(job_info, scan=False)
+
+    def _build_job_note(self, job_info, scan=True):
+        # scan=False only uses an estimate that is already cached, for the authenticate path
+        started = self._metrics.now()
+        note_text = "File: N/A, Filament: N/A" # Default note
+        try:
+            filename = "N/A"; filament_str = "N/A"
+            if job_info and job_info.get("file", {}).get("path"):
+                file_path = job_info["file"]["path"]; file_origin = job_info["file"]["origin"]
+                filename = job_info["file"].get("display", file_path)
+                self._logger.info(f"Current job: {filename} (origin: {file_origin})")
+                filament_str = self._filament_text(self._job_filament(file_origin, file_path, scan=scan))
+            else:
+                self._logger.warning("Could not get current job info to include in note.")
+
+            note_text = f"File: {filename}, Filament: {filament_str}"
+            self._logger.info(f"Generated note for API: {note_text}")
+        except Exception as e_note:
+            self._logger.error(f"Error generating note: {e_note}", exc_info=True)
+        self._metrics.since("job_note", started)
+        return note_text
+
+    def _filament_text(self, filament):
+        # The "Filament: ..." part of the note
+        if filament and filament["estimated"]:
+            return f"{filament['length']:.1f}mm / {filament['volume']:.1f}cm3 / {filament['weight']:.1f}g (estimated)"
+        if filament:
+            usage_parts = []
+            if filament["length"]: usage_parts.append(f"{filament['length']:.1f}mm")
+            if filament["volume"]: usage_parts.append(f"{filament['volume']:.1f}cm3")
+            if usage_parts: return ' / '.join(usage_parts)
+            self._logger.info("Filament usage data present but no length/volume found.")
+        return "N/A"
+
+    def _job_filament(self, origin, path, scan=True):
+        # Filament use of a file as dict(length, volume, weight, estimated): OctoPrint's analysis
+        # (first tool, no weight), else our own G-code estimate, else None
+        metadata = self._file_manager.get_metadata(origin, path) or {}
+        filament_data = metadata.get("analysis", {}).get("filament", {})
+        if filament_data:
+            # Check modern tool-specific format first
+            tool_usage = next(iter(filament_data.values()), None) if isinstance(list(filament_data.values())[0], dict) else None
+            usage = tool_usage if tool_usage else filament_data # Fallback for older format
+            return dict(length=usage.get("length"), volume=usage.get("volume"), weight=None, estimated=False)
+        self._logger.info("No filament analysis data found in metadata.")
+        estimate = self._estimate_filament(origin, path, scan)
+        if estimate:
+            return dict(estimate, estimated=True)
+        return None
 
-        # Construct params
-        params = {'source': tool_name, 'method': api_method}
-        if note: params['note'] = note
+    def _estimate_filament(self, origin, path, scan=True):
+        # Filament totals from our own G-code scan, or None when disabled/unavailable.
+        # scan=False returns None instead of reading a file that hasn't been scanned yet.
+        if not self._settings.get_boolean(["gcode_estimator_enabled"]) or not self._filament_estimator:
+            return None
+        if origin != "local" or not path:
+            return None # Files on the printer's SD card can't be read from here
+        try:
+            disk_path = self._file_manager.path_on_disk(origin, path)
+            lengths = self._filament_estimator.estimate(disk_path) if scan else self._filament_estimator.cached(disk_path)
+            if not lengths:
+                return None
+            return filament_usage(lengths, self._settings.get_float(["filament_diameter"]) or 1.75,
+                                  self._settings.get_float(["filament_density"]) or 1.24)
+        except (OSError, ValueError, TypeError) as e:
+            self._logger.warning(f"Could not estimate filament usage for {path}: {e}")
+        except Exception as e:
+            self._logger.error(f"Unexpected error estimating filament usage for {path}: {e}", exc_info=True)
+        return None
+
+
+    # -- Authentication Pipeline --
+    def _run_authentication(self, email):
+        # Runs the whole authenticate flow for one email and returns the result dict for the frontend.
+        # Called directly on the API thread, or on the worker pool in async mode.
+        self._logger.info(f"Attempting permission check via API command for email: {email}")
+        self._metrics.inc("authentications")
+
+        # --- Construct Note ---
+        # Normally already built by the PrintStarted warm-up, so this is just a lookup
+        note_text = self._get_job_note()
+        job = self._current_job_key(self._printer.get_current_job())
+
+        # --- Call Authentication Logic ---
+        result = {"success": False, "message": "Authentication failed by default."}
+        try:
+             result = self.handle_authentication(email, note=note_text, job=job) # Pass the detailed note
+
+             # Check result and decide if print should be cancelled
+             is_permission_failure = not result.get("success", False) and \
+                                     ("permission denied" in result.get("message","").lower() or \
+                                      "user not found" in result.get("message","").lower() or \
+                                      "lacks required permission" in result.get("message","").lower() or \
+                                      "not granted" in result.get("message","").lower())
+
+             if not result.get("success", False):
+                  if is_permission_failure:
+                      self._logger.warning(f"Permission check failed for {email}. Canceling print. Reason: {result.get('message')}")
+                      self._metrics.inc("denied")
+                      self._metrics.inc("cancels")
+                      self._printer.cancel_print()
+                      result["message"] += ". Print canceled."
+                  else: # Login, Network, or Settings Error
+                       if self._is_network_failure(result): self._metrics.inc("network_errors")
+                       self._logger.error(f"Authentication failed due to server/login/network/settings issue for {email}: {result.get('message')}")
+                       # Add advice for user in message already includes "notify staff" if login/network
+                       # result["message"] += ". Please notify staff." # Maybe redundant
+             else:
+                  # Success case: message includes name, potentially materials list
+                  self._logger.info(f"Authentication/Permission check successful for {email}. Materials fetched (if enabled).")
+                  self._metrics.inc("granted")
+                  # Don't automatically proceed print here, wait for confirm_material if materials included
+
+        except Exception as e:
+             # Catch unexpected errors during handle_authentication call
+             self._logger.error(f"Unhandled exception during handle_authentication call for {email}: {e}", exc_info=True)
+             self._metrics.inc("cancels")
+             self._printer.cancel_print() # Cancel on unexpected error
+             result = {"success": False, "message": f"Server error during authentication. Print canceled. {e}"}
+        return result
+
+
+    # -- Non-blocking Authenticate Jobs --
+    def _submit_authentication(self, email):
+        # One authentication at a time per printer; a double-submit gets the job that is already running
+        with self._auth_jobs_lock:
+            active = self._active_auth_job
+            if active and active["state"] == "pending":
+                self._logger.info(f"Authentication {active['request_id']} already in progress, not starting another for {email}.")
+                return dict(active), True
+
+            job = dict(request_id=uuid.uuid4().hex, email=email, state="pending", submitted=time.time(), result=None,
+                       queued_at=self._metrics.now()) # Time to modal includes waiting for a worker
+            self._auth_jobs[job["request_id"]] = job
+            self._active_auth_job = job
+            while len(self._auth_jobs) > self.MAX_TRACKED_AUTH_JOBS:
+                self._auth_jobs.popitem(last=False) # Oldest first
+        self._logger.info(f"Queued authentication {job['request_id']} for {email}.")
+        self._auth_executor.submit(self._run_authentication_job, job)
+        return dict(job), False
+
+    def _run_authentication_job(self, job):
+        try:
+            result = self._run_authentication(job["email"])
+        except Exception as e: # _run_authentication already handles its own errors, this is a last resort
+            self._logger.error(f"Unhandled exception in authentication job {job['request_id']}: {e}", exc_info=True)
+            result = {"success": False, "message": f"Server error during authentication. {e}"}
+        with self._auth_jobs_lock:
+            job["result"] = result
+            job["state"] = "done"
+        self._plugin_manager.send_plugin_message(self._identifier, {"auth_result": dict(result, request_id=job["request_id"])})
+        self._metrics.since("time_to_modal", job["queued_at"])
+
+    def _get_auth_job_status(self, request_id=None):
+        with self._auth_jobs_lock:
+            job = self._auth_jobs.get(request_id) if request_id else self._active_auth_job
+            if not job:
+                return None
+            return dict(request_id=job["request_id"], state=job["state"], submitted=job["submitted"], result=job["result"])
+
+
+    # -- Pre-Authorization Tokens --
+    def _current_user_name(self):
+        # OctoPrint user behind the current API request; PrintStarted reports the same name as "user"
+        try:
+            import flask_login
+            user = flask_login.current_user
+            return user.get_name() if user and not user.is_anonymous else None
+        except Exception:
+            return None
+
+    def _printer_identity(self):
+        # Connection port and printer profile, so a token can't be used after switching printers
+        try:
+            _, port, _, profile = self._printer.get_current_connection()
+            return f"{port}|{(profile or {}).get('id')}"
+        except Exception:
+            return None
+
+    def _file_fingerprint(self, file_key):
+        # Changes when a local file is replaced under the same name; SD files only have their path
+        origin, path = file_key
+        if origin != "local":
+            return None
+        try:
+            stat = os.stat(self._file_manager.path_on_disk(origin, path))
+            return f"{stat.st_mtime_ns}|{stat.st_size}"
+        except (OSError, AttributeError, TypeError):
+            return None
+
+    def _submit_preauthorization(self, email, file_key, user):
+        token = dict(token=uuid.uuid4().hex, email=email, user=user, file_key=tuple(file_key),
+                     printer=self._printer_identity(), fingerprint=self._file_fingerprint(file_key))
+        self._logger.info(f"Pre-authorizing {email} for {file_key[1]} (user {user}).")
+        with self._preauth_lock:
+            self._preauth_running[token["file_key"]] = self._preauth_running.get(token["file_key"], 0) + 1
+        self._auth_executor.submit(self._run_preauthorization, token)
+        return token["token"]
+
+    def _run_preauthorization(self, token):
+        try:
+            self._check_preauthorization(token)
+        finally:
+            file_key = token["file_key"]
+            with self._preauth_lock:
+                remaining = self._preauth_running.pop(file_key, 1) - 1
+                if remaining:
+                    self._preauth_running[file_key] = remaining
+                started = self._print_awaiting_preauth
+                if remaining or not started or (started.get("origin"), started.get("path")) != file_key:
+                    started = None
+                else:
+                    self._print_awaiting_preauth = None
+            if started: # The print started while we were checking: use the token or prompt now
+                self._on_print_started(started)
+
+    def _check_preauthorization(self, token):
+        try:
+            origin, path = token["file_key"]
+            note = self._build_job_note({"file": {"origin": origin, "path": path, "display": os.path.basename(path)}}, scan=False)
+            result = self.handle_authentication(token["email"], note=note, record_usage=False, job=token["file_key"])
+        except Exception as e:
+            self._logger.error(f"Unhandled exception during pre-authorization for {token['email']}: {e}", exc_info=True)
+            result = {"success": False, "message": f"Server error during pre-authorization. {e}"}
+        if result.get("success"):
+            self._metrics.inc("preauthorizations")
+            token.update(note=note, result=result, expires=time.monotonic() + (self._settings.get_float(["preauthorize_token_ttl"]) or 900))
+            with self._preauth_lock:
+                # A newer pre-authorization for the same file replaces the older one
+                for key in [key for key, other in self._preauth_tokens.items() if other["file_key"] == token["file_key"]]:
+                    del self._preauth_tokens[key]
+                self._preauth_tokens[token["token"]] = token
+                while len(self._preauth_tokens) > self.MAX_TRACKED_AUTH_JOBS:
+                    self._preauth_tokens.popitem(last=False)
+        self._plugin_manager.send_plugin_message(self._identifier, {"preauth_result": dict(
+            success=result.get("success", False), message=result.get("message"), token=token["token"], path=token["file_key"][1])})
+
+    def _consume_preauthorization(self, payload):
+        # Returns and removes the token matching this PrintStarted (user, file, printer), or None
+        if not self._settings.get_boolean(["preauthorize_enabled"]):
+            return None
+        payload = payload or {}
+        file_key = (payload.get("origin"), payload.get("path"))
+        now = time.monotonic()
+        with self._preauth_lock:
+            for key in [key for key, token in self._preauth_tokens.items() if token["expires"] <= now]:
+                del self._preauth_tokens[key]
+            for key, token in reversed(list(self._preauth_tokens.items())):
+                if token["file_key"] == file_key and token["user"] == payload.get("user"):
+                    break
+            else:
+                return None
+            del self._preauth_tokens[key] # Single use, whether or not the remaining checks pass
+        if token["printer"] != self._printer_identity() or token["fingerprint"] != self._file_fingerprint(file_key):
+            self._logger.info(f"Ignoring pre-authorization for {file_key[1]}: printer or file changed since it was issued.")
+            return None
+        return token
+
+    def _start_preauthorized_print(self, token):
+        result = dict(token["result"], preauthorized=True)
+        self._logger.info(f"Print started with a pre-authorization for {token['email']}, skipping the email prompt.")
+        self._metrics.inc("preauth_hits")
+        material_prompt_enabled = self._config.material_prompt_enabled
+        print_id = self._record_authorized_print(token["email"], token["note"], self._config.tool_name, material_prompt_enabled,
+                                                 token["file_key"])
+        self._authorize_hold(material_prompt_enabled)
+        self._audit_decision(token["email"], result, "print", "preauthorization", token["file_key"], print_id)
+        self._plugin_manager.send_plugin_message(self._identifier, {"preauthorized": result})
+
+
+    # -- Authentication Logic (Uses Settings) --
+    def handle_authentication(self, email, note="N/A", record_usage=True, job=None):
+        # job: (origin, path) of the file being authorized, for the audit log
+        # --- Settings snapshot, validated when it was built ---
+        config = self._config
+        req_permission_name = config.permission_name
+        tool_name = config.tool_name
+        material_prompt_enabled = config.material_prompt_enabled
+        material_tool_id = config.material_tool_id
+        decision_cache_enabled = config.decision_cache_enabled
+
+        # Settings problems were logged when the snapshot was built
+        if config.error:
+            result = dict(success=False, message=config.error)
+            self._audit_decision(email, result, "print" if record_usage else "preauthorize", "settings", job)
+            return result
+
+        # --- Cached Decision ---
+        cache_key = DecisionCache.make_key(email, req_permission_name, tool_name)
+        if decision_cache_enabled:
+            cached_result = self._decision_cache.get(cache_key)
+            self._metrics.inc("decision_cache_hits" if cached_result is not None else "decision_cache_misses")
+            if cached_result is not None:
+                self._logger.info(f"Permission decision for {email} served from cache (success={cached_result.get('success')}).")
+            result = cached_result
+        else:
+            result = None
+        source = "cache"
+
+        # --- Local Member Index (primary mode) ---
+        offline_mode = config.offline_auth_mode
+        if result is None and offline_mode == "primary":
+            result = self._lookup_member_index(email, req_permission_name, note) # None unless a fresh list has the member
+            source = "member_list"
+
+        materials_future = None
+        if result is None:
+            if material_prompt_enabled:
+                # Fetched while the API decides; only used if permission is granted, otherwise it just warms the cache
+                materials_future = self._io_executor.submit(self.fetch_materials, material_tool_id)
+            result, cacheable = self._check_permission_coalesced(email, req_permission_name, decision_cache_enabled)
+            source = "api"
+            if decision_cache_enabled and cacheable:
+                self._decision_cache.put(cache_key, result) # Materials are cached separately, per tool
+            if offline_mode in ("fallback", "primary") and self._is_network_failure(result):
+                self._metrics.inc("offline_decisions")
+                result = self._offline_decision(email, req_permission_name, note, result)
+                source = "offline"
+
+        # Fetch materials ONLY if permission granted and setting is enabled
+        print_id = None
+        if result.get("success"):
+            if record_usage: # Pre-authorizations are recorded when the print actually starts
+                print_id = self._record_authorized_print(email, note, tool_name, material_prompt_enabled, job)
+                self._authorize_hold(material_prompt_enabled)
+            if material_prompt_enabled:
+                self._logger.info(f"Material prompt enabled, fetching materials for Tool ID: {material_tool_id}...")
+                with self._metrics.time("materials_fetch"): # What the member waits for, usually a cache hit
+                    if materials_future is not None:
+                        result["materials"] = materials_future.result() # Add key ONLY if enabled
+                    else:
+                        result["materials"] = self.fetch_materials(material_tool_id)
+            else:
+                self._logger.info("Material prompt disabled via settings.")
+        self._audit_decision(email, result, "print" if record_usage else "preauthorize", source, job, print_id)
+        return result
+
+
+    def _check_permission_coalesced(self, email, permission_name, share):
+        # Permission check behind the shared cache: a decision another instance already made is reused,
+        # and concurrent checks for the same member across instances make a single API request.
+        def check():
+            # Ensure session exists or login
+            session_error = self._ensure_session()
+            if session_error:
+                return session_error, False
+            # The usage note goes through the outbox, keeping the interactive GET small and
+            # tagged as a lookup so the API does not count it as a second use of the printer
+            with self._metrics.time("permission_check"):
+                return self._check_permission(email, None, lookup=True)
+
+        if not self._shared or not share:
+            return check()
+        outcome = {}
+        def shared_check():
+            result, cacheable = check()
+            outcome["cacheable"] = cacheable
+            return result, self._decision_cache.ttl_for(result) if cacheable else 0
+        result, from_shared = self._shared.coalesce(self._shared_decision_key(email, permission_name), shared_check)
+        if from_shared:
+            self._metrics.inc("shared_cache_hits")
+            self._logger.info(f"Permission decision for {email} served from the shared cache (success={result.get('success')}).")
+            return result, True
+        return result, outcome.get("cacheable", False)
+
+    def _ensure_session(self):
+        # Returns an error result dict if no logged-in session could be established, else None.
+        # Logins are serialized by ApiSession, so concurrent callers wait for a single login.
+        login_result, login_message = self._api.ensure_logged_in()
+        if login_result is None: # Network error during login
+            return dict(success=False, message=login_message)
+        if not login_result: # Login credentials failed
+            return dict(success=False, message=login_message)
+        return None # If login_result is True, proceed
+
+
+    def _check_permission(self, email, note, tool_name=None, lookup=False):
+        # Performs the permission GET. Returns (result dict, cacheable) where cacheable is
+        # True only for definitive answers from the API (never for network/settings errors).
+        # tool_name overrides the configured source, for notes recorded under an older setting;
+        # lookup marks the interactive check, as opposed to a usage record.
+        import requests
+        from .api_session import SessionExpiredError
+        from .circuit_breaker import CircuitOpenError
+        config = self._config
+        req_permission_name = config.permission_name
+        if config.error:
+            return dict(success=False, message=config.error), False
+
+        # URL template and params were checked when the settings snapshot was built
+        api_url = config.permission_url(email)
+        params = config.permission_params(note, tool_name, lookup)
 
         self._logger.info(f"Checking permission API: {api_url} with params: {params}")
         try:
-            response = self._session.get(api_url, params=params, timeout=15)
+            response = self._api.get(api_url, params=params) # Adaptive connect/read timeouts
             self._logger.info(f"API response status: {response.status_code}")
             self._logger.debug(f"API response text: {response.text[:500]}") # Log response start
 
@@ -252,30 +989,23 @@ class PrintAuthPlugin(
                          self._logger.info(f"Permission '{req_permission_name}' granted for {user_name} ({email}).")
 
                          # Prepare return data
-                         return_data = dict(success=True,
-                                            message=f"Authenticated as {user_name}",
-                                            firstName=first_name,
-                                            lastName=last_name)
-
-                         # Fetch materials ONLY if setting is enabled
-                         if material_prompt_enabled:
-                             self._logger.info(f"Material prompt enabled, fetching materials for Tool ID: {material_tool_id}...")
-                             material_list = self.fetch_materials(material_tool_id) # Use validated ID
-                             return_data["materials"] = material_list # Add key ONLY if enabled
-                         else:
-                             self._logger.info("Material prompt disabled via settings.")
-
-                         return return_data # Return success dict
+                         return dict(success=True,
+                                     message=f"Authenticated as {user_name}",
+                                     firstName=first_name,
+                                     lastName=last_name), True
                          # --- End Permission Granted ---
                      else:
                          # Status OK but JSON doesn't indicate access
                          self._logger.warning(f"API Status OK but response JSON did not indicate access for {email}. Response: {json_data}")
-                         return dict(success=False, message=f"Permission '{req_permission_name}' not granted for user (API check).")
+                         return dict(success=False, message=f"Permission '{req_permission_name}' not granted for user (API check)."), True
 
                  except json.JSONDecodeError:
                      # Status OK but response not JSON
                      self._logger.warning("API returned Status OK but response was not valid JSON. Treating as failure.")
-                     return dict(success=False, message="Invalid response from permission API")
+                     return dict(success=False, message="Invalid response from permission API"), False
+            elif response.status_code >= 500: # The API is failing, not answering; never cancel a print over it
+                 self._logger.error(f"Permission API server error for {email}. Status: {response.status_code}")
+                 return dict(success=False, message=f"Network error: API server error (Status: {response.status_code})"), False
             else: # response not ok (e.g., 403, 404)
                  message = f"Permission denied or user not found by API (Status: {response.status_code})"
                  try: # Attempt to get error message from API JSON response
@@ -284,111 +1014,469 @@ class PrintAuthPlugin(
                          message = error_data["message"]
                  except json.JSONDecodeError: pass # Keep original status code message
                  self._logger.warning(f"Permission check failed for {email}. Status: {response.status_code}")
-                 return dict(success=False, message=message)
+                 # Expired logins were already renewed by ApiSession, so a 403/404 here is a real answer
+                 return dict(success=False, message=message), response.status_code in (403, 404)
 
         # --- Exception handling for the requests.get call and processing ---
+        except SessionExpiredError as e:
+             self._logger.error(f"Could not renew API session for permission check: {e}")
+             return dict(success=False, message=str(e)), False
+        except CircuitOpenError as e:
+             self._logger.warning(f"Permission check for {email} not attempted: {e}")
+             return dict(success=False, message=f"Network error: {e}"), False
         except requests.exceptions.Timeout:
              self._logger.error(f"Timeout connecting to permission API: {api_url}")
-             return dict(success=False, message="Network error: API connection timed out")
+             return dict(success=False, message="Network error: API connection timed out"), False
         except requests.exceptions.RequestException as e:
             self._logger.error(f"Network/Request error during permission API request to {api_url}: {e}")
-            return dict(success=False, message=f"Network error during permission check: {e}")
+            return dict(success=False, message=f"Network error during permission check: {e}"), False
         except Exception as e:
             self._logger.error(f"Unexpected error during permission check processing: {e}", exc_info=True)
-            return dict(success=False, message=f"Unexpected server error during permission check: {e}")
+            return dict(success=False, message=f"Unexpected server error during permission check: {e}"), False
 
 
-    # -- Login Logic (Uses Settings) --
-    def login_to_api(self):
-        if not self._session:
-            self._logger.info("Creating new requests session for API login.")
-            self._session = requests.Session()
-            headers = { # Add headers from working example
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.155 Safari/537.36",
-                "cache-control": "private, max-age=0, no-cache",
-            }
-            self._session.headers.update(headers)
-
-        # Get login credentials from settings
-        login_url = self._settings.get(["login_url"])
-        username = self._settings.get(["username"])
-        password = self._settings.get(["password"])
-
-        # Check if settings are actually configured
-        if not all([login_url, username, password]):
-             self._logger.error("API login credentials or URL missing in plugin settings.")
-             return False, "Plugin settings error: API Login credentials/URL missing."
-
-        # Login form data
-        data = {"name": username, "pass": password, "form_id": "user_login", "op": "Log in"}
-        self._logger.info(f"Attempting login post to {login_url} for configured user '{username}'")
+    @staticmethod
+    def _is_network_failure(result):
+        # The API could not be reached at all, as opposed to answering or rejecting our settings/login
+        return not result.get("success") and result.get("message", "").startswith("Network error")
+
+
+    # -- Offline Authorization --
+    def _lookup_member_index(self, email, permission_name, note):
+        # Granted result from a fresh member list, or None if the list is stale or lacks the member
+        age = self._member_index.age(permission_name)
+        max_staleness = self._config.member_index_max_staleness
+        if age is None or (max_staleness and age > max_staleness):
+            return None
+        names = self._member_index.lookup(email, permission_name)
+        if names is None:
+            return None
+        return self._offline_grant(email, permission_name, note, names)
+
+    def _offline_decision(self, email, permission_name, note, online_result):
+        # Called when the API is unreachable: answer from the member list, or fail open/closed
+        config = self._config
+        age = self._member_index.age(permission_name)
+        max_staleness = config.member_index_max_staleness
+        if age is None or (max_staleness and age > max_staleness):
+            if config.offline_fail_open:
+                self._logger.warning(f"API unreachable and member list unusable (synced {self._member_index.age_description()}). Allowing print for {email} (fail-open).")
+                return dict(success=True, message="Authentication service unreachable, print allowed", firstName="", lastName="", offline=True)
+            self._logger.error(f"API unreachable and member list unusable (synced {self._member_index.age_description()}). Refusing {email} (fail-closed).")
+            return online_result
+
+        names = self._member_index.lookup(email, permission_name)
+        if names is None:
+            self._logger.warning(f"API unreachable, {email} not in offline member list for '{permission_name}'.")
+            return dict(success=False, message=f"Permission '{permission_name}' not granted for user (offline member list).")
+        self._logger.warning(f"API unreachable, authorizing {email} from offline member list.")
+        return self._offline_grant(email, permission_name, note, names)
+
+    def _offline_grant(self, email, permission_name, note, names):
+        first_name, last_name = names
+        user_name = f"{first_name} {last_name}".strip() or "User"
+        self._logger.info(f"Permission '{permission_name}' granted for {user_name} ({email}) from offline member list.")
+        return dict(success=True, message=f"Authenticated as {user_name}", firstName=first_name, lastName=last_name, offline=True)
+
+    def _offline_sync_loop(self):
+        # Keeps the member list fresh while offline mode is enabled
+        while not self._background_stop.wait(60):
+            try:
+                if self._settings.get(["offline_auth_mode"]) in ("fallback", "primary") and self._settings.get(["member_roster_url_template"]):
+                    age = self._member_index.age(self._config.permission_name)
+                    interval = self._settings.get_float(["member_sync_interval"]) or 3600
+                    if age is None or age >= interval:
+                        self._sync_member_index()
+            except Exception as e:
+                self._logger.error(f"Unexpected error in offline sync loop: {e}", exc_info=True)
+
+    def _sync_member_index(self):
+        import requests
+        config = self._config
+        permission_name = config.permission_name
         try:
-            response = self._session.post(login_url, data=data, timeout=15)
-            self._logger.info(f"Login POST response status: {response.status_code}")
-            self._logger.debug(f"Login POST response URL after request: {response.url}")
-            self._logger.debug(f"Login POST response text snippet: {response.text[:500]}")
-
-            # Check for non-OK status first
-            if not response.ok:
-                 self._logger.error(f"Login failed for user '{username}'. HTTP Status: {response.status_code}.")
-                 return False, f"API service login failed (HTTP Status {response.status_code})"
-
-            # Refined Success Check
-            logged_in_check = "Log out" in response.text or "user/logout" in response.text
-            # Check if still looks like login page (indicates failure)
-            on_login_page_check = "user/login" in response.url and "form_id=user_login" in response.text
-
-            if response.ok and (logged_in_check or not on_login_page_check):
-                 self._logger.info(f"Login successful for user '{username}'.")
-                 return True, "Login successful"
-            else:
-                 self._logger.error(f"Login failed for user '{username}'. Status OK but success indicators not found.")
-                 self._session = None # Clear potentially bad session
-                 return False, "API service login credentials failed or unexpected response"
+            roster_url = self._settings.get(["member_roster_url_template"]).format(permission=config.quoted_permission)
+        except Exception as e:
+            self._logger.error(f"Error formatting member roster URL: {e}")
+            return False
+        session_error = self._ensure_session()
+        if session_error:
+            self._logger.warning(f"Member list sync skipped: {session_error.get('message')}")
+            return False
 
-        except requests.exceptions.Timeout:
-             self._logger.error(f"Timeout during login to API: {login_url}")
-             self._session = None
-             return None, "Network error during login: Timeout" # Return None for success status on network error
+        self._logger.info(f"Syncing offline member list from {roster_url}")
+        try:
+            response = self._api.get(roster_url, timeout=(self._api.timeouts.connect, 30)) # Large list, fixed read timeout
+            response.raise_for_status()
+            roster = response.json()
+            if not isinstance(roster, list):
+                self._logger.error(f"Member roster response was not a list: {str(roster)[:500]}")
+                return False
+            members = []
+            for item in roster: # Plain email strings, or objects like the permission API's user data
+                if isinstance(item, str):
+                    members.append((item, "", ""))
+                elif isinstance(item, dict):
+                    members.append((item.get("email") or item.get("mail"), item.get("first_name", ""), item.get("last_name", "")))
+            count = self._member_index.replace(permission_name, members)
+            self._logger.info(f"Offline member list synced: {count} member(s) with '{permission_name}'.")
+            return True
         except requests.exceptions.RequestException as e:
-            self._logger.error(f"Login to API failed with exception: {e}", exc_info=True)
-            self._session = None
-            return None, f"Network error during login: {e}" # Return None for success status on network error
+            self._logger.warning(f"Member list sync failed: {e}")
+        except ValueError as e: # Includes JSONDecodeError
+            self._logger.error(f"Member roster response was not valid JSON: {e}")
+        return False
+
+    # -- Print Hold (G-code queuing hook) --
+    # With hold_until_authorized the first line the job reads from its file
+    # puts the job on hold (OctoPrint's job hold, which stops the file reader
+    # and the job queue while the terminal keeps working). A harmless first
+    # line is sent; a first line that heats or moves is kept back and sent on
+    # release, just before the hold is lifted and the job carries on from the
+    # next line of the file. Once released (or when the feature is off) the
+    # hook returns after reading one attribute.
+    def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        if not self._hold_armed:
+            return None
+        if not tags or "source:file" not in tags:
+            return None # Start script, terminal, other plugins and pause/cancel scripts pass
+        with self._hold_lock:
+            if not self._hold_armed or self._hold_active: # Released while we waited for the lock
+                return None
+            if not self._config.credentials_configured:
+                self._hold_armed = False # Can't authenticate anyone, so don't hold the job forever
+                return None
+            self._start_hold_locked()
+            hold_line = gcode in self.HOLD_COMMANDS
+            if hold_line:
+                self._held_line = (cmd, set(tags))
+        # On the comm thread: never wait here for the hold lock, another plugin may hold it while waiting on us
+        if self._printer.set_job_on_hold(True, blocking=False) is False:
+            thread = threading.Thread(target=self._hold_job, name="PrintAuthHold")
+            thread.daemon = True
+            thread.start()
+        return (None,) if hold_line else None
+
+    def _start_hold_locked(self):
+        timeout = self._settings.get_float(["hold_timeout"]) or 300
+        self._logger.info(f"Holding print before its first heat/move command until authorized (timeout {timeout:.0f}s).")
+        self._metrics.inc("holds")
+        self._hold_active = True
+        self._hold_timer = threading.Timer(timeout, self._hold_timed_out)
+        self._hold_timer.daemon = True
+        self._hold_timer.start()
+
+    def _hold_job(self):
+        # The job hold lock was busy when the hook ran
+        self._set_job_on_hold(True)
+        with self._hold_lock:
+            still_held = self._hold_active
+        if not still_held: # Released while we waited for the lock
+            self._set_job_on_hold(False)
+
+    def _set_job_on_hold(self, value):
+        try:
+            self._printer.set_job_on_hold(value)
+        except RuntimeError as e: # Printer disconnected, the job is gone anyway
+            self._logger.warning(f"Could not {'hold' if value else 'release'} the print job: {e}")
+
+    def _arm_hold(self):
+        # Resets the gate for the next job, lifting a hold that is still in place
+        with self._hold_lock:
+            if self._hold_timer:
+                self._hold_timer.cancel()
+            self._hold_timer = None
+            was_active = self._hold_active
+            self._hold_active = self._hold_authorized = False
+            self._held_line = None # The job it belonged to is over
+            self._hold_armed = self._settings.get_boolean(["hold_until_authorized"])
+        if was_active:
+            self._set_job_on_hold(False)
+
+    def _authorize_hold(self, material_prompt_enabled):
+        # Authenticate succeeded; without a material prompt that's all the job waits for
+        with self._hold_lock:
+            self._hold_authorized = True
+        if not material_prompt_enabled:
+            self._release_hold("authorized")
+
+    def _release_hold(self, reason):
+        # Returns True if a held job was resumed
+        with self._hold_lock:
+            if not self._hold_armed:
+                return False
+            self._hold_armed = False # From here on the hook is back to its fast path
+            if self._hold_timer:
+                self._hold_timer.cancel()
+            self._hold_timer = None
+            was_active, self._hold_active = self._hold_active, False
+            held_line, self._held_line = self._held_line, None
+        if not was_active:
+            return False
+        self._logger.info(f"Releasing held print ({reason}).")
+        if held_line:
+            cmd, tags = held_line
+            self._printer.commands(cmd, tags=tags) # Sent while the job is still on hold, so it goes out first
+        self._set_job_on_hold(False)
+        return True
+
+    def _drop_hold(self):
+        # The job is being cancelled: its cancel commands queue behind our hold, so lift it
+        with self._hold_lock:
+            if self._hold_timer:
+                self._hold_timer.cancel()
+            self._hold_timer = None
+            was_active, self._hold_active = self._hold_active, False
+            self._held_line = None # Never reached the printer, and mustn't now
+        if was_active:
+            self._logger.info("Held print is being cancelled, lifting the hold.")
+            self._set_job_on_hold(False)
+
+    def _hold_timed_out(self):
+        with self._hold_lock:
+            if not self._hold_active:
+                return
+        self._logger.warning("Held print was not authorized in time, cancelling it.")
+        self._metrics.inc("hold_timeouts")
+        self._discard_pending_usage()
+        self._plugin_manager.send_plugin_message(self._identifier, {"hold_timeout": {
+            "message": "Print was not authorized in time and has been cancelled."}})
+        self._metrics.inc("cancels")
+        self._printer.cancel_print() # No more file lines once it is cancelling; PrintCancelled re-arms the gate
+        self._drop_hold()
+
+    # -- Usage Outbox --
+    def _record_authorized_print(self, email, note, tool_name, material_prompt_enabled, job=None):
+        # The record is written to the outbox right away, so a crash or restart mid-print can't lose it.
+        # With the material prompt it is only delivered after confirm_material (or the end of the print).
+        # job is the (origin, path) the note describes. Returns the print's audit log id.
+        print_id = uuid.uuid4().hex
+        # The same print is the same member and file; the note can gain its estimate in between
+        usage = dict(email=email, note=note, tool_name=tool_name, print_id=print_id, same_print=(email, job or note))
+        if not material_prompt_enabled:
+            usage["outbox_id"] = self._store_usage(usage, job)
+            return print_id
+        with self._pending_usage_lock:
+            previous = self._pending_usage
+            if previous is not None and previous["same_print"] == usage["same_print"]:
+                return previous["print_id"] # Same print authorized again, it already has its record
+            usage["outbox_id"] = self._store_usage(usage, job, awaiting_material=True)
+            self._pending_usage = usage
+        if previous:
+            self._finish_usage(previous, "unconfirmed") # Earlier print never got a material choice
+        return print_id
+
+    def _complete_pending_usage(self, material_choice):
+        with self._pending_usage_lock:
+            pending, self._pending_usage = self._pending_usage, None
+        if pending:
+            self._finish_usage(pending, material_choice)
+        return pending
+
+    def _discard_pending_usage(self):
+        # The print never ran, so there is nothing to bill
+        with self._pending_usage_lock:
+            pending, self._pending_usage = self._pending_usage, None
+        if pending and pending["outbox_id"] is not None:
+            try:
+                self._usage_outbox.discard(pending["outbox_id"])
+            except Exception as e:
+                self._logger.error(f"Could not remove usage record {pending['outbox_id']} of a cancelled print: {e}", exc_info=True)
+
+    def _store_usage(self, usage, job=None, material_choice=None, awaiting_material=False):
+        # Inserts the record and returns its outbox id, or None if it couldn't be written
+        awaiting_estimate = bool(job and usage["note"].endswith("Filament: N/A") and self._scan_executor)
+        try:
+            entry_id = self._usage_outbox.enqueue(usage["email"], usage["note"], usage["tool_name"], material_choice,
+                                                  awaiting_material, awaiting_estimate)
+        except Exception as e: # Never let bookkeeping break the print; the log still has the record
+            self._logger.error(f"Could not write usage record to outbox for {usage['email']} ({usage['note']}, material: {material_choice}): {e}", exc_info=True)
+            return None
+        if awaiting_estimate:
+            # Note built without a cold G-code scan; the scan worker fills in the estimate
+            try:
+                self._scan_executor.submit(self._fill_usage_estimate, entry_id, usage["note"], job)
+            except RuntimeError as e: # Shutting down; deliver the record without the estimate
+                self._logger.warning(f"Could not estimate filament usage for the usage record of {usage['email']}: {e}")
+                self._update_usage(entry_id, self._usage_outbox.set_note, usage["note"])
+        elif not awaiting_material:
+            self._outbox_wakeup.set()
+        return entry_id
+
+    def _finish_usage(self, usage, material_choice):
+        if usage["outbox_id"] is None: # Couldn't be written when the print was authorized, try once more
+            self._store_usage(usage, material_choice=material_choice)
+        else:
+            self._update_usage(usage["outbox_id"], self._usage_outbox.set_material, material_choice)
+        if self._audit_log:
+            self._audit_log.record_material(usage["print_id"], material_choice)
+
+    def _fill_usage_estimate(self, entry_id, note, job):
+        origin, path = job
+        try:
+            filament = self._job_filament(origin, path)
+        except Exception as e:
+            self._logger.warning(f"Could not estimate filament usage for usage record {entry_id}: {e}")
+            filament = None
+        if filament:
+            note = note[:-len("N/A")] + self._filament_text(filament)
+        self._update_usage(entry_id, self._usage_outbox.set_note, note)
+
+    def _update_usage(self, entry_id, update, value):
+        try:
+            update(entry_id, value)
+            self._outbox_wakeup.set()
+        except Exception as e:
+            self._logger.error(f"Could not update usage record {entry_id} in the outbox ({value}): {e}", exc_info=True)
+
+    def _usage_flush_loop(self):
+        # Delivers outbox entries in batches; backs off exponentially while the API is failing
+        failures = 0
+        while not self._background_stop.is_set():
+            if failures:
+                delay = min(self._settings.get_float(["usage_retry_max_delay"]) or 3600,
+                            (self._settings.get_float(["usage_retry_base_delay"]) or 30) * (2 ** (failures - 1)))
+            else:
+                delay = self._settings.get_float(["usage_flush_interval"]) or 60
+            self._outbox_wakeup.wait(delay)
+            self._outbox_wakeup.clear()
+            if self._background_stop.is_set():
+                break
+            try:
+                delivered, failed = self._flush_usage_outbox()
+                failures = failures + 1 if failed else 0
+                if failed:
+                    self._logger.info(f"Usage delivery failed, {self._usage_outbox.count()} record(s) left in outbox. Retry {failures}.")
+                elif delivered >= (self._settings.get_int(["usage_batch_size"]) or 20):
+                    self._outbox_wakeup.set() # Full batch, more may be waiting
+            except Exception as e:
+                failures += 1
+                self._logger.error(f"Unexpected error flushing usage outbox: {e}", exc_info=True)
+
+    def _flush_usage_outbox(self):
+        # Sends one batch over the pooled session. The API has no bulk endpoint, so each record
+        # is one permission GET carrying the note. Returns (delivered, failed), failed meaning the
+        # API could not be reached and the whole batch should be retried later.
+        delivered = 0
+        max_attempts = self._settings.get_int(["usage_max_attempts"]) or 10
+        for entry in self._usage_outbox.pending(self._settings.get_int(["usage_batch_size"]) or 20):
+            note = entry["note"] or ""
+            if entry["material_choice"]:
+                note = f"{note}, Material: {entry['material_choice']}"
+            if self._ensure_session():
+                return delivered, True # Login failed, no record could go through
+            result, cacheable = self._check_permission(entry["email"], note, entry["tool_name"])
+            if result.get("success") or cacheable:
+                if not result.get("success"):
+                    self._logger.warning(f"Usage record for {entry['email']} was delivered but permission is now denied.")
+                    self._decision_cache.invalidate(entry["email"]) # Membership changed, re-check next print
+                self._usage_outbox.ack(entry["id"])
+                delivered += 1
+            elif self._is_network_failure(result):
+                return delivered, True # API unreachable or circuit open, the record itself is fine
+            elif self._usage_outbox.mark_failed(entry["id"], result.get("message"), max_attempts):
+                # Rejected by the API; try the rest of the batch and stop retrying this one after max_attempts
+                self._metrics.inc("usage_parked")
+                self._logger.error(f"Usage record {entry['id']} for {entry['email']} was rejected {max_attempts} times "
+                                   f"and is parked in the outbox: {result.get('message')}")
+            else:
+                self._logger.warning(f"Usage record {entry['id']} for {entry['email']} was rejected: {result.get('message')}")
+        if delivered:
+            self._logger.info(f"Delivered {delivered} usage record(s) from outbox.")
+        return delivered, False
+
+
+    # -- Login Logic (Uses Settings) --
+    def login_to_api(self):
+        # Forces a fresh login; returns (True/False/None, message), None meaning a network error
+        return self._api.login()
 
 
     # -- Fetch Materials Function --
     def fetch_materials(self, tool_id):
-        if not self._session:
-            self._logger.error("Cannot fetch materials: No active API session.")
-            return []
         if not tool_id: # Added check for valid tool_id
             self._logger.error("Cannot fetch materials: Invalid Tool ID provided.")
             return []
+        # Served from the materials cache; only the very first lookup per tool waits on the network
+        return self._materials_cache.get(tool_id)
+
+    def _materials_url(self, tool_id):
+        return self._config.materials_url(tool_id)
+
+    def _fetch_materials(self, tool_id, etag=None, last_modified=None):
+        # Fetcher for MaterialsCache: the download, shared with the other instances when configured
+        if not self._shared:
+            return self._download_materials(tool_id, etag, last_modified)
+        key = f"materials:{self._materials_url(tool_id)}"
+        ttl = self._settings.get_float(["materials_cache_max_age"]) or 3600
 
-        materials_url = f"https://makehaven.org/api/v0/materials/equipment/{tool_id}"
-        self._logger.info(f"Fetching materials from: {materials_url}")
+        def download():
+            status, materials, new_etag, new_last_modified = self._download_materials(tool_id, etag, last_modified)
+            if status == FETCH_OK:
+                return dict(materials=materials, etag=new_etag, last_modified=new_last_modified), ttl
+            if status == FETCH_NOT_MODIFIED:
+                previous = self._shared.get(key) # Possibly past its revalidation time, but the server says it's current
+                if previous and previous[0].get("etag") and previous[0].get("etag") == (new_etag or etag):
+                    return previous[0], ttl
+                return dict(not_modified=True, etag=new_etag or etag, last_modified=new_last_modified), 0
+            return dict(error=True), 0
+
+        fresh_after = time.time() - (self._settings.get_float(["materials_revalidate_interval"]) or 0)
+        value, from_shared = self._shared.coalesce(key, download, fresh_after=fresh_after)
+        if from_shared:
+            self._metrics.inc("shared_cache_hits")
+        if value.get("error"):
+            return FETCH_ERROR, None, None, None
+        if value.get("not_modified") or (etag and value.get("etag") == etag):
+            return FETCH_NOT_MODIFIED, None, value.get("etag"), value.get("last_modified")
+        return FETCH_OK, value.get("materials"), value.get("etag"), value.get("last_modified")
+
+    def _download_materials(self, tool_id, etag=None, last_modified=None):
+        # Fetcher for MaterialsCache: returns (status, materials, etag, last_modified)
+        import requests
+        from .circuit_breaker import CircuitOpenError
+        materials_url = self._materials_url(tool_id)
+        if not materials_url:
+            self._logger.error("Cannot fetch materials: Materials URL template is invalid.")
+            return FETCH_ERROR, None, None, None
+        session_error = self._ensure_session()
+        if session_error:
+            self._logger.error(f"Cannot fetch materials: No active API session. {session_error.get('message')}")
+            return FETCH_ERROR, None, None, None
+
+        self._metrics.inc("materials_downloads")
+        headers = {}
+        if etag: headers["If-None-Match"] = etag
+        if last_modified: headers["If-Modified-Since"] = last_modified
+        self._logger.info(f"Fetching materials from: {materials_url} (conditional: {bool(headers)})")
         try:
-            response = self._session.get(materials_url, timeout=10)
+            response = self._api.get(materials_url, headers=headers)
+            if response.status_code == 304:
+                self._logger.info(f"Materials for Tool ID {tool_id} not modified, keeping cached list.")
+                return FETCH_NOT_MODIFIED, None, response.headers.get("ETag"), response.headers.get("Last-Modified")
             response.raise_for_status() # Check for HTTP errors
             materials_list = response.json()
             if isinstance(materials_list, list):
                 self._logger.info(f"Successfully fetched {len(materials_list)} materials.")
-                return materials_list
+                return FETCH_OK, materials_list, response.headers.get("ETag"), response.headers.get("Last-Modified")
             else:
                 self._logger.error(f"Materials API response was not a list: {materials_list}")
-                return []
+                return FETCH_ERROR, None, None, None
+        except CircuitOpenError as e:
+             self._logger.warning(f"Materials fetch for Tool ID {tool_id} not attempted: {e}")
+             return FETCH_ERROR, None, None, None
         except requests.exceptions.Timeout:
              self._logger.error(f"Timeout connecting to materials API: {materials_url}")
-             return []
+             return FETCH_ERROR, None, None, None
         except requests.exceptions.RequestException as e:
             self._logger.error(f"Error during materials API request to {materials_url}: {e}")
-            return []
+            return FETCH_ERROR, None, None, None
         except json.JSONDecodeError:
              self._logger.error(f"Failed to decode JSON response from materials API: {materials_url}. Response text: {response.text[:500]}")
-             return []
+             return FETCH_ERROR, None, None, None
         except Exception as e:
             self._logger.error(f"Unexpected error fetching/processing materials: {e}", exc_info=True)
-            return []
+            return FETCH_ERROR, None, None, None
 
 
 # --- Plugin Registration ---
@@ -400,6 +1488,7 @@ def __plugin_load__():
     global __plugin_implementation__
     __plugin_implementation__ = PrintAuthPlugin()
 
-    # If you needed hooks:
-    # global __plugin_hooks__
-    # __plugin_hooks__ = { ... }
\ No newline at end of file
+    global __plugin_hooks__
+    __plugin_hooks__ = {
+        "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.hook_gcode_queuing
+    }
\ No newline at end of file
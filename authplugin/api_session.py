@@ -0,0 +1,361 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, urlunsplit
+
+from .circuit_breaker import AdaptiveTimeout, CircuitBreaker, CircuitOpenError
+from .transport import InflightRequests, RequestsTransport, create_transport
+
+
+# Headers from the working login example; the site rejects the default requests User-Agent
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.155 Safari/537.36",
+    "cache-control": "private, max-age=0, no-cache",
+}
+
+
+class SessionExpiredError(requests.exceptions.RequestException):
+    # Login could not be (re-)established; a RequestException so network error handling still applies
+    pass
+
+
+# --- API Session Lifecycle ---
+# Owns the logged-in requests.Session for the MakeHaven website. Drupal login
+# cookies expire server side without telling us, so every GET is checked for
+# the tell-tale signs of an expired login (redirect to user/login, or a 403
+# that renders the login form) and retried once after logging in again. The
+# session is also refreshed before max_age, and a keep-alive thread pings the
+# site while idle so the cookie and pooled TLS connections stay warm.
+# Every request passes through a circuit breaker and adaptive timeouts, so
+# an outage fails prints fast instead of each one waiting out a timeout.
+#
+# credentials is a callable returning (login_url, username, password);
+# on_circuit_change(snapshot) is told when the breaker opens or closes;
+# metrics (optional) receives login timings and upstream request counts.
+# With a SharedStore, instances on the same host share one login: a fresh
+# session published by another instance is adopted instead of logging in,
+# and only the instance holding the login lease posts the login form.
+# GETs go through a pluggable transport (requests, or httpx with HTTP/2 when
+# installed) and identical GETs in flight at the same time share one request.
+class ApiSession(object):
+
+    SHARED_SESSION_KEY = "session"
+    SHARED_LOGIN_LEASE = "login"
+
+    def __init__(self, credentials, logger, clock=time.monotonic, on_circuit_change=None, metrics=None, shared=None):
+        self._credentials = credentials
+        self._logger = logger
+        self._metrics = metrics
+        self.shared = shared
+        self._session_wall_time = None # Wall-clock login time of the current session, compared across instances
+        self._clock = clock
+        self._lock = threading.RLock() # Held across login so concurrent callers wait for one login
+        self._session = None
+        self._logged_in_at = None
+        self._last_used = 0.0
+        self._keepalive_thread = None
+        self._keepalive_stop = threading.Event()
+        self.max_age = 21600
+        self.keepalive_interval = 600
+        self.pool_size = 4
+        self.breaker = CircuitBreaker(logger, on_change=on_circuit_change)
+        self.timeouts = AdaptiveTimeout()
+        self.transport = RequestsTransport()
+        self._inflight = InflightRequests()
+
+    def configure(self, max_age, keepalive_interval, pool_size):
+        pool_size = max(1, int(pool_size))
+        with self._lock:
+            if pool_size != self.pool_size and self._session:
+                self.reset() # Adapters are mounted at creation, so resize by starting over
+            self.max_age = max(0.0, float(max_age))
+            self.keepalive_interval = max(0.0, float(keepalive_interval))
+            self.pool_size = pool_size
+
+    def set_transport(self, name):
+        # "requests" or "httpx"; falls back to requests when httpx isn't installed
+        if name == self.transport.name and getattr(self.transport, "pool_size", self.pool_size) == self.pool_size:
+            return
+        old, self.transport = self.transport, create_transport(name, self._logger, self.pool_size)
+        old.close()
+
+    def close(self):
+        self.stop_keepalive()
+        self.transport.close()
+
+    @property
+    def logged_in(self):
+        return self._session is not None and self._logged_in_at is not None
+
+    def reset(self):
+        with self._lock:
+            if self._session:
+                self._session.close()
+            self._session = None
+            self._logged_in_at = None
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        # Reuse TCP/TLS connections to the API host instead of re-handshaking per request
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    # -- Login --
+    def login(self):
+        # Returns (True, msg) on success, (False, msg) on rejected credentials/settings, (None, msg) on network errors
+        with self._lock:
+            if not self._session:
+                self._logger.info("Creating new requests session for API login.")
+                self._session = self._new_session()
+            self._logged_in_at = None
+
+            # Get login credentials from settings
+            login_url, username, password = self._credentials()
+
+            # Check if settings are actually configured
+            if not all([login_url, username, password]):
+                 self._logger.error("API login credentials or URL missing in plugin settings.")
+                 return False, "Plugin settings error: API Login credentials/URL missing."
+
+            # Login form data
+            data = {"name": username, "pass": password, "form_id": "user_login", "op": "Log in"}
+            self._logger.info(f"Attempting login post to {login_url} for configured user '{username}'")
+            started = time.perf_counter()
+            try:
+                # Logins are slower than API GETs, so they always get the full read timeout
+                response = self._send(self._session.post, login_url, data=data, timeout=(self.timeouts.connect, self.timeouts.read_max))
+                if self._metrics:
+                    self._metrics.observe("login", time.perf_counter() - started)
+                self._logger.info(f"Login POST response status: {response.status_code}")
+                self._logger.debug(f"Login POST response URL after request: {response.url}")
+                self._logger.debug(f"Login POST response text snippet: {response.text[:500]}")
+
+                # Check for non-OK status first
+                if not response.ok:
+                     self._logger.error(f"Login failed for user '{username}'. HTTP Status: {response.status_code}.")
+                     self.reset()
+                     return False, f"API service login failed (HTTP Status {response.status_code})"
+
+                # Refined Success Check
+                logged_in_check = "Log out" in response.text or "user/logout" in response.text
+                # Check if still looks like login page (indicates failure)
+                on_login_page_check = "user/login" in response.url and "form_id=user_login" in response.text
+
+                if logged_in_check or not on_login_page_check:
+                     self._logger.info(f"Login successful for user '{username}'.")
+                     self._logged_in_at = self._last_used = self._clock()
+                     self._session_wall_time = time.time()
+                     self._publish_session()
+                     return True, "Login successful"
+                else:
+                     self._logger.error(f"Login failed for user '{username}'. Status OK but success indicators not found.")
+                     self.reset() # Clear potentially bad session
+                     return False, "API service login credentials failed or unexpected response"
+
+            except CircuitOpenError as e:
+                 self._logger.warning(f"Skipping login: {e}")
+                 return None, f"Network error during login: {e}"
+            except requests.exceptions.Timeout:
+                 self._logger.error(f"Timeout during login to API: {login_url}")
+                 self.reset()
+                 return None, "Network error during login: Timeout" # Return None for success status on network error
+            except requests.exceptions.RequestException as e:
+                self._logger.error(f"Login to API failed with exception: {e}", exc_info=True)
+                self.reset()
+                return None, f"Network error during login: {e}" # Return None for success status on network error
+
+    def ensure_logged_in(self):
+        # Same return convention as login(); only logs in when there is no session or it is too old
+        with self._lock:
+            if self.logged_in:
+                age = self._clock() - self._logged_in_at
+                if not self.max_age or age < self.max_age:
+                    return True, "Session active"
+                self._logger.info(f"API session is {age:.0f}s old (max {self.max_age:.0f}s), logging in again.")
+            else:
+                self._logger.info("No active session, attempting API login.")
+            return self._renew()
+
+    def _renew(self, newer_than=None):
+        # Adopts another instance's fresher session if there is one, otherwise logs in (once per host)
+        with self._lock:
+            if self._adopt_shared_session(newer_than):
+                return True, "Using shared session"
+            if not self.shared:
+                return self.login()
+            if self.shared.acquire(self.SHARED_LOGIN_LEASE, 30):
+                try:
+                    return self.login()
+                finally:
+                    self.shared.release(self.SHARED_LOGIN_LEASE)
+            self._logger.info("Another instance is logging in, waiting for its session.")
+            deadline = time.monotonic() + 30
+            while self.shared.lease_held(self.SHARED_LOGIN_LEASE) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if self._adopt_shared_session(newer_than):
+                return True, "Using shared session"
+            return self.login()
+
+    # -- Shared Session --
+    def _shared_identity(self):
+        login_url, username, _ = self._credentials()
+        return f"{login_url}|{username}"
+
+    def _publish_session(self):
+        if not self.shared or not self._session:
+            return
+        cookies = [dict(name=c.name, value=c.value, domain=c.domain, path=c.path, secure=c.secure, expires=c.expires)
+                   for c in self._session.cookies]
+        self.shared.put(self.SHARED_SESSION_KEY, dict(identity=self._shared_identity(), logged_in_at=self._session_wall_time,
+                                                      cookies=cookies), self.max_age or 86400)
+
+    def _adopt_shared_session(self, newer_than=None):
+        # Caller holds the lock. newer_than skips the session we already know is stale.
+        if not self.shared:
+            return False
+        entry = self.shared.get(self.SHARED_SESSION_KEY)
+        if entry is None:
+            return False
+        record = entry[0]
+        if record.get("identity") != self._shared_identity() or not record.get("cookies"):
+            return False # Another instance logs in with different settings
+        logged_in_at = record.get("logged_in_at") or 0
+        if newer_than is not None and logged_in_at <= newer_than:
+            return False
+        age = max(0.0, time.time() - logged_in_at)
+        if self.max_age and age >= self.max_age:
+            return False
+        if not self._session:
+            self._session = self._new_session()
+        self._session.cookies.clear()
+        for cookie in record["cookies"]:
+            self._session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain") or "",
+                                      path=cookie.get("path") or "/", secure=cookie.get("secure", False), expires=cookie.get("expires"))
+        self._logged_in_at = self._last_used = self._clock() - age
+        self._session_wall_time = logged_in_at
+        self._logger.info(f"Using API session shared by another instance (logged in {age:.0f}s ago).")
+        return True
+
+    # -- Requests --
+    @staticmethod
+    def is_login_response(response):
+        # Drupal answers requests from an expired session with the login page
+        if "user/login" in (response.url or ""):
+            return True
+        if response.status_code in (401, 403):
+            text = response.text or ""
+            return "user_login" in text or "user-login-form" in text
+        return False
+
+    def get(self, url, **kwargs):
+        # GET with the logged-in session; an expired login is renewed and the request retried once.
+        # Raises requests exceptions like Session.get, and SessionExpiredError if the retry fails too.
+        # Callers asking for the same URL, params and headers while a request is in flight share it.
+        key = (url, repr(sorted((kwargs.get("params") or {}).items())), repr(sorted((kwargs.get("headers") or {}).items())),
+               repr(kwargs.get("timeout")))
+        response, merged = self._inflight.run(key, lambda: self._get(url, **kwargs))
+        if merged and self._metrics:
+            self._metrics.inc("merged_requests")
+        return response
+
+    def _get(self, url, **kwargs):
+        ok, message = self.ensure_logged_in()
+        if not ok:
+            raise SessionExpiredError(message)
+
+        session, seen_login = self._session, self._logged_in_at
+        response = self._send(self._transport_get(session), url, **kwargs)
+        if self.is_login_response(response):
+            self._logger.warning(f"API session expired (status {response.status_code}, URL {response.url}), logging in again.")
+            with self._lock:
+                if self._logged_in_at == seen_login or not self.logged_in: # Another thread may have renewed it already
+                    ok, message = self._renew(newer_than=self._session_wall_time)
+                    if not ok:
+                        raise SessionExpiredError(message)
+                session = self._session
+            response = self._send(self._transport_get(session), url, **kwargs)
+            if self.is_login_response(response):
+                self.reset()
+                raise SessionExpiredError("API session rejected right after logging in (credentials failed or account lacks API access)")
+        self._last_used = self._clock()
+        return response
+
+    def _transport_get(self, session):
+        transport = self.transport
+        return lambda url, **kwargs: transport.get(session, url, **kwargs)
+
+    def _send(self, send, url, **kwargs):
+        # Runs one request through the breaker; without an explicit timeout the adaptive one is used
+        try:
+            self.breaker.before_request()
+        except CircuitOpenError:
+            if self._metrics:
+                self._metrics.inc("circuit_rejections")
+            raise
+        if self._metrics:
+            self._metrics.inc("upstream_requests")
+        adaptive = "timeout" not in kwargs
+        if adaptive:
+            kwargs["timeout"] = self.timeouts.current()
+        try:
+            response = send(url, **kwargs)
+        except requests.exceptions.ReadTimeout as e:
+            if adaptive:
+                self.timeouts.observe(kwargs["timeout"][1]) # At least this slow, so later timeouts grow
+            self.breaker.record_failure(e)
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self.breaker.record_failure(e)
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure(f"HTTP {response.status_code} from {url}")
+        else:
+            self.breaker.record_success()
+            if adaptive:
+                self.timeouts.observe(response.elapsed.total_seconds())
+        return response
+
+    # -- Keep-Alive --
+    def start_keepalive(self):
+        if self._keepalive_thread and self._keepalive_thread.is_alive():
+            return
+        self._keepalive_stop.clear()
+        self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="PrintAuthSessionKeepAlive")
+        self._keepalive_thread.daemon = True
+        self._keepalive_thread.start()
+
+    def stop_keepalive(self):
+        self._keepalive_stop.set()
+
+    def _keepalive_loop(self):
+        while not self._keepalive_stop.wait(max(5.0, min(self.keepalive_interval or 60.0, 60.0))):
+            if not self.keepalive_interval or not self.logged_in:
+                continue
+            try:
+                now = self._clock()
+                if self.max_age and now - self._logged_in_at >= self.max_age * 0.9:
+                    # Refresh ahead of max_age so no print ever waits on a login
+                    self._logger.info("Refreshing API session before it reaches its maximum age.")
+                    self._renew(newer_than=self._session_wall_time)
+                elif now - self._last_used >= self.keepalive_interval:
+                    self._logger.debug("Sending API session keep-alive.")
+                    self.get(self._site_root())
+            except SessionExpiredError as e:
+                self._logger.warning(f"API session keep-alive could not log in again: {e}")
+            except requests.exceptions.RequestException as e:
+                self._logger.info(f"API session keep-alive failed: {e}")
+            except Exception as e:
+                self._logger.error(f"Unexpected error in API session keep-alive: {e}", exc_info=True)
+
+    def _site_root(self):
+        login_url = self._credentials()[0]
+        parts = urlsplit(login_url)
+        return urlunsplit((parts.scheme, parts.netloc, "/", "", ""))
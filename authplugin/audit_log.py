@@ -0,0 +1,248 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import queue
+import sqlite3
+import threading
+import time
+
+from .decision_cache import DecisionCache
+
+
+# --- Local Audit Log of Auth Decisions ---
+# Every permission decision and material choice, in an indexed SQLite table
+# (WAL mode) so usage questions ("prints per member this month") are index
+# range queries instead of log greps. Callers only put records on a queue;
+# a single writer thread inserts them in batches, so the audit log adds no
+# latency to authentication. The file is kept under a size limit by
+# dropping the oldest rows.
+#
+# A row with printed=1 is a print that was authorized and started. Its
+# print_id ties it to the later material choice; re-authenticating the same
+# print moves printed=1 to the newest row, so every print counts once.
+class AuditLog(object):
+
+    COLUMNS = ("id", "ts", "email", "tool", "origin", "file", "kind", "granted", "source", "message",
+               "print_id", "printed", "material", "filament_mm", "filament_g")
+    MAX_QUEUED = 10000 # Records waiting for the writer; beyond this they are dropped, never blocking a print
+    BATCH_SIZE = 200
+    RETENTION_CHECK_INTERVAL = 500 # Rows written between database size checks
+    MAX_PAGE_SIZE = 200
+
+    def __init__(self, db_path, logger, job_details=None, clock=time.time):
+        # job_details(origin, path) -> dict(filament_mm=..., filament_g=...) or None, called on the writer thread
+        self._db_path = db_path
+        self._logger = logger
+        self._job_details = job_details
+        self._clock = clock
+        self._queue = queue.Queue(self.MAX_QUEUED)
+        self._writer = None
+        self._written_since_check = 0
+        self.max_bytes = 20 * 1024 * 1024
+        self._init_db()
+
+    def configure(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+
+    def _connect(self):
+        return sqlite3.connect(self._db_path, timeout=10)
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL") # Only takes effect on a new file, before the first table
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS audit (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                email TEXT NOT NULL,
+                tool TEXT,
+                origin TEXT,
+                file TEXT,
+                kind TEXT NOT NULL,
+                granted INTEGER NOT NULL,
+                source TEXT,
+                message TEXT,
+                print_id TEXT,
+                printed INTEGER NOT NULL DEFAULT 0,
+                material TEXT,
+                filament_mm REAL,
+                filament_g REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS audit_email_ts ON audit (email, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS audit_ts ON audit (ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS audit_tool_ts ON audit (tool, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS audit_file_ts ON audit (file, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS audit_print_id ON audit (print_id)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    # -- Recording (any thread) --
+    def record_decision(self, email, tool, kind, granted, source=None, message=None, job=None, print_id=None):
+        # job is (origin, path) of the file being authorized, or None
+        origin, path = job or (None, None)
+        self._put(("decision", dict(ts=self._clock(), email=DecisionCache.normalize_email(email), tool=tool,
+                                    origin=origin, file=path, kind=kind, granted=1 if granted else 0,
+                                    source=source, message=(message or "")[:500], print_id=print_id,
+                                    printed=1 if print_id else 0)))
+
+    def record_material(self, print_id, material):
+        if print_id and material:
+            self._put(("material", dict(print_id=print_id, material=material)))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._logger.warning(f"Audit log queue full, dropping {item[0]} record.")
+
+    # -- Writer Thread --
+    def start(self):
+        if self._writer and self._writer.is_alive():
+            return
+        self._writer = threading.Thread(target=self._write_loop, name="PrintAuthAuditWriter")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def stop(self, timeout=5):
+        # Writes what is already queued, then ends the writer thread
+        if not self._writer:
+            return
+        self._queue.put(None)
+        self._writer.join(timeout)
+        self._writer = None
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            self._enforce_retention(conn)
+            while True:
+                items = [self._queue.get()]
+                while len(items) < self.BATCH_SIZE:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in items
+                try:
+                    self._write_batch(conn, [item for item in items if item is not None])
+                except sqlite3.Error as e:
+                    self._logger.error(f"Could not write {len(items)} audit record(s): {e}")
+                except Exception as e:
+                    self._logger.error(f"Unexpected error writing audit records: {e}", exc_info=True)
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, items):
+        if not items:
+            return
+        self._add_job_details(items) # May read metadata or scan G-code, so not inside the write transaction
+        with conn:
+            for item_type, record in items:
+                if item_type == "material":
+                    conn.execute("UPDATE audit SET material = ? WHERE print_id = ? AND printed = 1",
+                                 (record["material"], record["print_id"]))
+                    continue
+                if record["print_id"]: # Same print authorized again, only the newest row counts
+                    conn.execute("UPDATE audit SET printed = 0 WHERE print_id = ?", (record["print_id"],))
+                columns = [column for column in self.COLUMNS[1:] if column in record]
+                conn.execute(f"INSERT INTO audit ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                             [record[column] for column in columns])
+                self._written_since_check += 1
+        if self._written_since_check >= self.RETENTION_CHECK_INTERVAL:
+            self._enforce_retention(conn)
+
+    def _add_job_details(self, items):
+        # One lookup per file in the batch
+        if not self._job_details:
+            return
+        details = {}
+        for item_type, record in items:
+            if item_type != "decision" or not record["file"]:
+                continue
+            job = (record["origin"], record["file"])
+            if job not in details:
+                details[job] = self._job_details(*job) or {}
+            record.update(details[job])
+
+    def _enforce_retention(self, conn):
+        # Deletes the oldest rows until the file is back under 90% of max_bytes
+        self._written_since_check = 0
+        if not self.max_bytes:
+            return
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        used = (conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]) * page_size
+        if used <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT COUNT(*) FROM audit").fetchone()[0]
+        drop = max(1, int(rows * (1 - 0.9 * self.max_bytes / used)))
+        with conn:
+            conn.execute("DELETE FROM audit WHERE id <= (SELECT id FROM audit ORDER BY id LIMIT 1 OFFSET ?)", (drop - 1,))
+        conn.executescript("PRAGMA incremental_vacuum;") # execute() would step it once, freeing a single page
+        self._logger.info(f"Audit log over {self.max_bytes // 1024} kB, removed the {drop} oldest record(s).")
+
+    # -- Queries (any thread) --
+    def usage_by_member(self, since=None, until=None, tool=None, email=None, limit=50, offset=0):
+        filters = dict(tool=tool, email=DecisionCache.normalize_email(email) if email else None)
+        return self._usage("email", since, until, filters, limit, offset)
+
+    def usage_by_file(self, since=None, until=None, tool=None, email=None, limit=50, offset=0):
+        filters = dict(tool=tool, email=DecisionCache.normalize_email(email) if email else None)
+        return self._usage("file", since, until, filters, limit, offset)
+
+    def _usage(self, group_by, since, until, filters, limit, offset):
+        # Aggregated prints per group in [since, until); pages are ordered by print count
+        where, params = self._where(since, until, filters, ["printed = 1"])
+        limit, offset = self._page(limit, offset)
+        sql = (f"SELECT {group_by}, COUNT(*), SUM(filament_mm), SUM(filament_g), "
+               f"SUM(material = 'paid'), SUM(material = 'own_material'), SUM(material = 'unconfirmed'), MIN(ts), MAX(ts) "
+               f"FROM audit WHERE {where} GROUP BY {group_by} ORDER BY COUNT(*) DESC, {group_by} LIMIT ? OFFSET ?")
+        conn = self._connect()
+        try:
+            total = conn.execute(f"SELECT COUNT(DISTINCT {group_by}) FROM audit WHERE {where}", params).fetchone()[0]
+            rows = conn.execute(sql, params + [limit, offset]).fetchall()
+        finally:
+            conn.close()
+        items = [{group_by: row[0], "prints": row[1], "filament_mm": row[2], "filament_g": row[3], "paid": row[4] or 0,
+                  "own_material": row[5] or 0, "unconfirmed": row[6] or 0, "first": row[7], "last": row[8]} for row in rows]
+        return dict(total=total, limit=limit, offset=offset, since=since, until=until, items=items)
+
+    def decisions(self, since=None, until=None, tool=None, email=None, file=None, limit=50, offset=0):
+        # Individual records, newest first
+        filters = dict(tool=tool, email=DecisionCache.normalize_email(email) if email else None, file=file)
+        where, params = self._where(since, until, filters)
+        limit, offset = self._page(limit, offset)
+        conn = self._connect()
+        try:
+            total = conn.execute(f"SELECT COUNT(*) FROM audit WHERE {where}", params).fetchone()[0]
+            rows = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM audit WHERE {where} ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                                params + [limit, offset]).fetchall()
+        finally:
+            conn.close()
+        return dict(total=total, limit=limit, offset=offset, since=since, until=until,
+                    items=[dict(zip(self.COLUMNS, row)) for row in rows])
+
+    @staticmethod
+    def _where(since, until, filters, conditions=None):
+        conditions = list(conditions or [])
+        params = []
+        if since is not None:
+            conditions.append("ts >= ?"); params.append(float(since))
+        if until is not None:
+            conditions.append("ts < ?"); params.append(float(until))
+        for column, value in filters.items():
+            if value:
+                conditions.append(f"{column} = ?"); params.append(value)
+        return " AND ".join(conditions) or "1", params
+
+    def _page(self, limit, offset):
+        return max(1, min(int(limit or 50), self.MAX_PAGE_SIZE)), max(0, int(offset or 0))
+
+    def count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM audit").fetchone()[0]
+        finally:
+            conn.close()
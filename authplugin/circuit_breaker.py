@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+
+import requests
+
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    # Raised instead of contacting the API while the breaker is open; a ConnectionError
+    # so every existing "Network error" path (and the offline fallback) handles it as-is
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super(CircuitOpenError, self).__init__(f"MakeHaven auth service unavailable, not retrying for {retry_in:.0f}s")
+
+
+# --- Circuit Breaker ---
+# Shared by every call to the MakeHaven website. After failure_threshold
+# consecutive failures (connection errors, timeouts, 5xx) the circuit opens
+# and requests fail immediately for reset_timeout seconds instead of each
+# print waiting out a full timeout. After the cool-down one request is let
+# through as a probe (half-open): success closes the circuit, failure opens
+# it for another cool-down. Other callers keep failing fast during the probe.
+#
+# on_change(snapshot) is called outside the lock whenever the state changes.
+class CircuitBreaker(object):
+
+    def __init__(self, logger, on_change=None, clock=time.monotonic):
+        self._logger = logger
+        self._on_change = on_change
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+        self._last_error = None
+        self.failure_threshold = 3
+        self.reset_timeout = 60.0
+
+    def configure(self, failure_threshold, reset_timeout):
+        with self._lock:
+            self.failure_threshold = max(1, int(failure_threshold))
+            self.reset_timeout = max(1.0, float(reset_timeout))
+
+    def before_request(self):
+        # Raises CircuitOpenError if the request must not be sent
+        with self._lock:
+            if self._state == STATE_CLOSED:
+                return
+            now = self._clock()
+            if self._state == STATE_OPEN:
+                remaining = self._opened_at + self.reset_timeout - now
+                if remaining > 0:
+                    raise CircuitOpenError(remaining)
+                self._state = STATE_HALF_OPEN
+                self._probe_started = now
+                self._logger.info("Auth service circuit half-open, sending a probe request.")
+                return # This caller is the probe; no listener cares about half-open
+            # Half-open: one probe at a time, unless it has been stuck for a whole cool-down
+            if now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError(self.reset_timeout - (now - self._probe_started))
+            self._probe_started = now
+
+    def record_success(self):
+        with self._lock:
+            changed = self._state != STATE_CLOSED
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._opened_at = self._probe_started = None
+            self._last_error = None
+        if changed:
+            self._logger.info("Auth service circuit closed, API reachable again.")
+            self._notify()
+
+    def record_failure(self, error):
+        with self._lock:
+            self._failures += 1
+            self._last_error = str(error)[:200]
+            opening = self._state == STATE_HALF_OPEN or (self._state == STATE_CLOSED and self._failures >= self.failure_threshold)
+            if opening:
+                self._state = STATE_OPEN
+                self._opened_at = self._clock()
+                self._probe_started = None
+        if opening:
+            self._logger.warning(f"Auth service circuit open after {self._failures} consecutive failure(s), failing fast for {self.reset_timeout:.0f}s. Last error: {error}")
+            self._notify()
+
+    def reset(self):
+        self.record_success()
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = None
+            if self._state == STATE_OPEN:
+                retry_in = max(0.0, self._opened_at + self.reset_timeout - self._clock())
+            return dict(state=self._state, failures=self._failures, retry_in=retry_in, last_error=self._last_error)
+
+    def _notify(self):
+        if not self._on_change:
+            return
+        try:
+            self._on_change(self.snapshot())
+        except Exception as e:
+            self._logger.error(f"Error in circuit breaker state listener: {e}", exc_info=True)
+
+
+# --- Adaptive Timeouts ---
+# Read timeouts follow the observed response times instead of a fixed 10-15s:
+# a multiple of the recent 95th percentile, clamped to [read_min, read_max].
+# Until enough samples exist read_max is used. The connect timeout is fixed
+# and short, since a healthy host accepts connections quickly.
+class AdaptiveTimeout(object):
+
+    MIN_SAMPLES = 10
+    PERCENTILE = 0.95
+    MULTIPLIER = 3.0
+
+    def __init__(self, window=100):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self.connect = 3.05
+        self.read_min = 2.0
+        self.read_max = 15.0
+
+    def configure(self, connect, read_min, read_max):
+        with self._lock:
+            self.connect = max(0.5, float(connect))
+            self.read_min = max(0.5, float(read_min))
+            self.read_max = max(self.read_min, float(read_max))
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(float(seconds))
+
+    def percentile(self, fraction):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    def read_timeout(self):
+        with self._lock:
+            enough = len(self._samples) >= self.MIN_SAMPLES
+        if not enough:
+            return self.read_max
+        return min(self.read_max, max(self.read_min, self.percentile(self.PERCENTILE) * self.MULTIPLIER))
+
+    def current(self):
+        # (connect, read) tuple for requests' timeout argument
+        return (self.connect, self.read_timeout())
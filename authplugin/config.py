@@ -0,0 +1,112 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from collections import namedtuple
+from urllib.parse import quote # What requests.utils.quote is, without importing requests
+
+
+DEFAULT_MATERIALS_URL_TEMPLATE = "https://makehaven.org/api/v0/materials/equipment/{tool_id}"
+
+_FIELDS = ("permission_check_url_template", "permission_name", "quoted_permission", "tool_name", "api_method",
+           "material_prompt_enabled", "material_tool_id", "materials_url_template", "decision_cache_enabled",
+           "offline_auth_mode", "member_index_max_staleness", "offline_fail_open", "credentials_configured",
+           "audit_enabled", "error", "problems")
+
+
+# --- Compiled Auth Settings ---
+# Immutable snapshot of the settings the authentication hot path reads,
+# built in on_startup and on_settings_save. Values are typed and the URL
+# templates checked once, so a print only formats the member's email into
+# a ready template. error is the message authenticate returns while the
+# settings are unusable; problems lists everything found, for the log.
+class AuthConfig(namedtuple("AuthConfig", _FIELDS)):
+
+    __slots__ = ()
+
+    @classmethod
+    def from_settings(cls, settings):
+        problems = []
+        error = None
+
+        permission_template = settings.get(["permission_check_url_template"]) or ""
+        permission_name = settings.get(["permission_name"]) or ""
+        tool_name = settings.get(["tool_name"]) or ""
+        api_method = settings.get(["api_method"]) or ""
+        if not all([permission_template, permission_name, tool_name, api_method]):
+            problems.append("Required settings are not fully configured (URL Template, Permission Name, Tool Name).")
+            error = "Plugin settings error: Core API/Permission settings missing."
+        elif not cls._formats(permission_template, email="member%40example.org", permission="permission"):
+            problems.append(f"Permission check URL template is invalid: '{permission_template}'.")
+            error = "Plugin settings error: Permission URL template invalid."
+
+        material_prompt_enabled = settings.get_boolean(["enable_material_prompt"])
+        material_tool_id_str = settings.get(["material_tool_id"])
+        material_tool_id = None
+        try:
+            material_tool_id = int(material_tool_id_str)
+            if material_tool_id <= 0:
+                raise ValueError("Tool ID must be positive")
+        except (ValueError, TypeError):
+            material_tool_id = None
+            if material_prompt_enabled:
+                if not material_tool_id_str:
+                    problems.append("Material prompt enabled, but Material Tool ID setting is empty.")
+                    error = error or "Plugin settings error: Material Tool ID missing."
+                else:
+                    problems.append(f"Invalid Material Tool ID configured: '{material_tool_id_str}'. Must be a positive number.")
+                    error = error or "Plugin settings error: Invalid Material Tool ID."
+
+        try:
+            max_staleness = max(0.0, float(settings.get(["member_index_max_staleness"]) or 0))
+        except (ValueError, TypeError):
+            problems.append(f"Invalid member list max age: '{settings.get(['member_index_max_staleness'])}', offline approvals use any list age.")
+            max_staleness = 0.0
+
+        materials_template = settings.get(["materials_url_template"]) or DEFAULT_MATERIALS_URL_TEMPLATE
+        if not cls._formats(materials_template, tool_id=1):
+            problems.append(f"Materials URL template is invalid: '{materials_template}', materials cannot be fetched.")
+            materials_template = None
+
+        return cls(
+            permission_check_url_template=permission_template,
+            permission_name=permission_name,
+            quoted_permission=quote(permission_name),
+            tool_name=tool_name,
+            api_method=api_method,
+            material_prompt_enabled=material_prompt_enabled,
+            material_tool_id=material_tool_id,
+            materials_url_template=materials_template,
+            decision_cache_enabled=settings.get_boolean(["decision_cache_enabled"]),
+            offline_auth_mode=settings.get(["offline_auth_mode"]) or "off",
+            member_index_max_staleness=max_staleness, # 0 = any age
+            offline_fail_open=settings.get_boolean(["offline_fail_open"]),
+            credentials_configured=bool(settings.get(["username"]) and settings.get(["password"])),
+            audit_enabled=settings.get_boolean(["audit_log_enabled"]),
+            error=error,
+            problems=tuple(problems)
+        )
+
+    @staticmethod
+    def _formats(template, **values):
+        try:
+            template.format(**values)
+            return True
+        except (KeyError, IndexError, ValueError, AttributeError):
+            return False
+
+    def permission_url(self, email):
+        return self.permission_check_url_template.format(email=quote(email), permission=self.quoted_permission)
+
+    def permission_params(self, note=None, tool_name=None, lookup=False):
+        # tool_name overrides the configured source, for notes recorded under an older setting.
+        # A lookup is the interactive check before a print; its method tells the API it is not a
+        # usage record, which follows separately from the outbox.
+        method = f"{self.api_method}_lookup" if lookup else self.api_method
+        params = {'source': tool_name or self.tool_name, 'method': method}
+        if note: params['note'] = note
+        return params
+
+    def materials_url(self, tool_id):
+        if not self.materials_url_template:
+            return None
+        return self.materials_url_template.format(tool_id=tool_id)
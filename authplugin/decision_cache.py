@@ -0,0 +1,86 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# --- Permission Decision Cache ---
+# Bounded in-process LRU of permission check results, keyed by
+# (normalized email, permission name, tool name). Granted and denied results
+# expire on separate TTLs so a revoked membership is still picked up quickly
+# while repeat prints by the same member skip the permission round trip.
+class DecisionCache(object):
+
+    def __init__(self, max_entries=256, granted_ttl=3600, denied_ttl=300, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires_at, result dict)
+        self._clock = clock
+        self._max_entries = 0
+        self._granted_ttl = 0.0
+        self._denied_ttl = 0.0
+        self.configure(max_entries, granted_ttl, denied_ttl)
+
+    @staticmethod
+    def normalize_email(email):
+        return (email or "").strip().lower()
+
+    @classmethod
+    def make_key(cls, email, permission_name, tool_name):
+        return (cls.normalize_email(email), permission_name, tool_name)
+
+    def configure(self, max_entries, granted_ttl, denied_ttl):
+        with self._lock:
+            self._max_entries = max(0, int(max_entries))
+            self._granted_ttl = max(0.0, float(granted_ttl))
+            self._denied_ttl = max(0.0, float(denied_ttl))
+            self._evict_overflow()
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key) # Mark as most recently used
+            return dict(result) # Copy so callers can't mutate the cached entry
+
+    def ttl_for(self, result):
+        return self._granted_ttl if result.get("success") else self._denied_ttl
+
+    def put(self, key, result):
+        ttl = self.ttl_for(result)
+        with self._lock:
+            if ttl <= 0 or self._max_entries <= 0:
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = (self._clock() + ttl, dict(result))
+            self._entries.move_to_end(key)
+            self._evict_overflow()
+
+    def invalidate(self, email=None):
+        # Drop every entry for one member, or the whole cache when no email is given
+        with self._lock:
+            if email is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            normalized = self.normalize_email(email)
+            stale_keys = [key for key in self._entries if key[0] == normalized]
+            for key in stale_keys:
+                del self._entries[key]
+            return len(stale_keys)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict_overflow(self):
+        # Caller must hold the lock
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False) # Least recently used first
@@ -0,0 +1,177 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+
+# --- Streaming Filament Estimator ---
+# Fallback for the usage note when OctoPrint's own analysis hasn't finished
+# (or never ran). Reads the G-code line by line through a large buffer, so
+# memory use stays constant for files of several hundred MB, and sums the
+# extrusion per tool the same way OctoPrint's analysis does: a signed running
+# total per tool whose maximum is the filament used, so retractions and
+# unretractions cancel out. Handles G90/G91, M82/M83, G92 resets, G20/G21
+# and tool changes (T0, T1, ...).
+READ_BUFFER_SIZE = 1024 * 1024
+MOVE_COMMANDS = (b"G0", b"G1", b"G2", b"G3")
+
+
+def scan_extrusion(path):
+    # Returns {tool index: filament length in mm} for one G-code file
+    relative_e = False
+    scale = 1.0 # G20 switches to inches
+    tool = 0
+    position = {} # Current E position per tool, as the firmware sees it
+    total = {} # Signed running extrusion per tool
+    maximum = {} # Highest running total per tool, i.e. filament used
+
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        for line in f:
+            comment_at = line.find(b";")
+            if comment_at != -1:
+                line = line[:comment_at]
+            checksum_at = line.find(b"*") # "N12 G1 E5*33" from hosts that number their lines
+            if checksum_at != -1:
+                line = line[:checksum_at]
+            words = line.split()
+            if not words:
+                continue
+            command = words[0]
+            if command[:1] in (b"N", b"n") and len(words) > 1: # Line numbers from some slicers/hosts
+                words = words[1:]
+                command = words[0]
+            if command[:1].islower():
+                command = command.upper()
+
+            if command in MOVE_COMMANDS:
+                # Most lines are moves, so look for an E word from the end (slicers put it last)
+                for word in reversed(words):
+                    if word[:1] in (b"E", b"e"):
+                        try:
+                            value = float(word[1:]) * scale
+                        except ValueError:
+                            break
+                        if relative_e:
+                            delta = value
+                            position[tool] = position.get(tool, 0.0) + value
+                        else:
+                            delta = value - position.get(tool, 0.0)
+                            position[tool] = value
+                        running = total.get(tool, 0.0) + delta
+                        total[tool] = running
+                        if running > maximum.get(tool, 0.0):
+                            maximum[tool] = running
+                        break
+            elif command == b"G92":
+                axes = words[1:]
+                if not axes: # Bare G92 resets every axis
+                    position[tool] = 0.0
+                for word in axes:
+                    if word[:1] in (b"E", b"e"):
+                        try:
+                            position[tool] = float(word[1:]) * scale
+                        except ValueError:
+                            pass
+            elif command == b"G90" or command == b"M82":
+                relative_e = False
+            elif command == b"G91" or command == b"M83":
+                relative_e = True
+            elif command == b"G20":
+                scale = 25.4
+            elif command == b"G21":
+                scale = 1.0
+            elif command[:1] == b"T":
+                try:
+                    tool = int(command[1:])
+                except ValueError:
+                    pass
+    return {index: length for index, length in maximum.items() if length > 0}
+
+
+def filament_usage(lengths, diameter, density):
+    # Turns per-tool lengths (mm) into the totals used in the note
+    length = sum(lengths.values())
+    volume = length * math.pi * (float(diameter) / 2.0) ** 2 / 1000.0 # mm3 -> cm3
+    return dict(length=length, volume=volume, weight=volume * float(density))
+
+
+class FilamentEstimator(object):
+    # Caches scan results by (path, mtime, size) so each file version is only read once.
+    # Results survive restarts in a small JSON file in the plugin data folder.
+
+    MAX_ENTRIES = 500
+
+    def __init__(self, cache_path, logger):
+        self._cache_path = cache_path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._scan_locks = {} # path -> Lock, so an upload scan and a print don't read the same file twice
+        self._entries = OrderedDict() # "path|mtime_ns|size" -> {tool: length}
+        self._load()
+
+    @staticmethod
+    def _cache_key(path):
+        stat = os.stat(path)
+        return f"{path}|{stat.st_mtime_ns}|{stat.st_size}"
+
+    def cached(self, path):
+        # Returns {tool index: length mm} if this version was already scanned, else None. Never
+        # scans and never waits for a running scan, so it is safe on the authenticate path.
+        key = self._cache_key(path)
+        with self._lock:
+            lengths = self._entries.get(key)
+            if lengths is None:
+                return None
+            self._entries.move_to_end(key)
+            return dict(lengths)
+
+    def estimate(self, path):
+        # Returns {tool index: length mm}, scanning the file only if this version hasn't been seen
+        with self._lock:
+            scan_lock = self._scan_locks.setdefault(path, threading.Lock())
+        with scan_lock:
+            key = self._cache_key(path)
+            with self._lock:
+                lengths = self._entries.get(key)
+                if lengths is not None:
+                    self._entries.move_to_end(key)
+                    return dict(lengths)
+
+            self._logger.info(f"Estimating filament usage for {path}")
+            lengths = scan_extrusion(path)
+            with self._lock:
+                # Earlier versions of the same file are useless now
+                for stale_key in [k for k in self._entries if k.rsplit("|", 2)[0] == path]:
+                    del self._entries[stale_key]
+                self._entries[key] = lengths
+                while len(self._entries) > self.MAX_ENTRIES:
+                    self._entries.popitem(last=False)
+                self._scan_locks.pop(path, None)
+            self._save()
+            return dict(lengths)
+
+    def _load(self):
+        if not os.path.exists(self._cache_path):
+            return
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            for key, lengths in stored.items():
+                self._entries[key] = {int(tool): float(length) for tool, length in lengths.items()}
+        except (OSError, ValueError, AttributeError) as e:
+            self._logger.warning(f"Ignoring unreadable filament estimate cache {self._cache_path}: {e}")
+
+    def _save(self):
+        with self._lock:
+            snapshot = {key: {str(tool): length for tool, length in lengths.items()} for key, lengths in self._entries.items()}
+        tmp_path = self._cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            self._logger.warning(f"Could not persist filament estimate cache to {self._cache_path}: {e}")
@@ -0,0 +1,141 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import time
+
+
+# --- Materials Catalog Cache ---
+# Per tool_id copy of the materials list. The last good list is always served
+# immediately; revalidation happens on a background thread using the ETag /
+# Last-Modified validators from the previous response, or a plain max-age when
+# the server sent none. Failed refreshes keep the stale list instead of
+# replacing it with nothing. Entries are persisted so a restart starts warm.
+#
+# The fetcher is called as fetcher(tool_id, etag, last_modified) and must
+# return (status, materials, etag, last_modified) where status is one of
+# FETCH_OK, FETCH_NOT_MODIFIED or FETCH_ERROR.
+FETCH_OK = "ok"
+FETCH_NOT_MODIFIED = "not_modified"
+FETCH_ERROR = "error"
+
+
+class MaterialsCache(object):
+
+    def __init__(self, fetcher, logger, persist_path=None, max_age=3600, revalidate_interval=60, clock=time.time):
+        self._fetcher = fetcher
+        self._logger = logger
+        self._persist_path = persist_path
+        self._clock = clock # Wall clock, since entries outlive the process
+        self._lock = threading.Lock()
+        self._entries = {} # str(tool_id) -> dict(materials, etag, last_modified, fetched_at, checked_at)
+        self._in_flight = set()
+        self.max_age = max_age
+        self.revalidate_interval = revalidate_interval
+
+    def configure(self, max_age, revalidate_interval):
+        self.max_age = max(0.0, float(max_age))
+        self.revalidate_interval = max(0.0, float(revalidate_interval))
+
+    # -- Lookup --
+    def get(self, tool_id):
+        key = str(tool_id)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            # Nothing to serve yet, so the first fetch has to be waited on
+            self._logger.info(f"No cached materials for Tool ID {key}, fetching now.")
+            entry = self._refresh(key)
+            return list(entry["materials"]) if entry else []
+        if self._needs_revalidation(entry):
+            self.refresh_async(key)
+        return list(entry["materials"])
+
+    def _needs_revalidation(self, entry):
+        now = self._clock()
+        if entry.get("etag") or entry.get("last_modified"):
+            # Conditional requests are cheap, just don't send them on every print
+            return now - entry.get("checked_at", 0) >= self.revalidate_interval
+        return now - entry.get("fetched_at", 0) >= self.max_age
+
+    # -- Refresh --
+    def refresh_async(self, tool_id):
+        key = str(tool_id)
+        with self._lock:
+            if key in self._in_flight:
+                return
+            self._in_flight.add(key)
+        thread = threading.Thread(target=self._refresh, args=(key, True), name="PrintAuthMaterialsRefresh")
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, key, in_flight_claimed=False):
+        if not in_flight_claimed:
+            with self._lock:
+                self._in_flight.add(key)
+        try:
+            with self._lock:
+                previous = self._entries.get(key)
+            etag = previous.get("etag") if previous else None
+            last_modified = previous.get("last_modified") if previous else None
+
+            status, materials, new_etag, new_last_modified = self._fetcher(key, etag, last_modified)
+            now = self._clock()
+
+            if status == FETCH_OK:
+                entry = dict(materials=materials, etag=new_etag, last_modified=new_last_modified, fetched_at=now, checked_at=now)
+            elif status == FETCH_NOT_MODIFIED and previous:
+                entry = dict(previous, checked_at=now, fetched_at=now)
+                if new_etag: entry["etag"] = new_etag
+                if new_last_modified: entry["last_modified"] = new_last_modified
+            else:
+                if previous:
+                    self._logger.warning(f"Materials refresh for Tool ID {key} failed, keeping cached list from {time.ctime(previous.get('fetched_at', 0))}.")
+                return previous
+
+            with self._lock:
+                self._entries[key] = entry
+            self._save()
+            return entry
+        except Exception as e:
+            self._logger.error(f"Unexpected error refreshing materials for Tool ID {key}: {e}", exc_info=True)
+            with self._lock:
+                return self._entries.get(key)
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._save()
+
+    # -- Persistence --
+    def load(self):
+        if not self._persist_path or not os.path.exists(self._persist_path):
+            return
+        try:
+            with open(self._persist_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            entries = {key: entry for key, entry in stored.items()
+                       if isinstance(entry, dict) and isinstance(entry.get("materials"), list)}
+            with self._lock:
+                self._entries.update(entries)
+            self._logger.info(f"Loaded cached materials for {len(entries)} tool(s) from {self._persist_path}")
+        except (OSError, ValueError, AttributeError) as e:
+            self._logger.warning(f"Ignoring unreadable materials cache file {self._persist_path}: {e}")
+
+    def _save(self):
+        if not self._persist_path:
+            return
+        with self._lock:
+            snapshot = dict(self._entries)
+        tmp_path = self._persist_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self._persist_path) # Atomic, a crash never leaves a half-written file
+        except OSError as e:
+            self._logger.warning(f"Could not persist materials cache to {self._persist_path}: {e}")
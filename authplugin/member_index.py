@@ -0,0 +1,102 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+from .decision_cache import DecisionCache
+
+
+# --- Local Member Permission Index ---
+# Periodically synced copy of the members holding the configured permission,
+# used to answer permission checks while makehaven.org is slow or down.
+# Only a SHA-256 of the normalized email is stored (plus the names shown in
+# the welcome message). The SQLite file is the durable copy; lookups are
+# answered from an in-memory dict loaded from it.
+class MemberIndex(object):
+
+    def __init__(self, db_path, logger, clock=time.time):
+        self._db_path = db_path
+        self._logger = logger
+        self._clock = clock # Wall clock, the index outlives the process
+        self._lock = threading.Lock()
+        self._members = {} # email hash -> (first_name, last_name)
+        self._permission_name = None
+        self._synced_at = None
+
+    @staticmethod
+    def hash_email(email):
+        return hashlib.sha256(DecisionCache.normalize_email(email).encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=10)
+        conn.execute("CREATE TABLE IF NOT EXISTS members (email_hash TEXT PRIMARY KEY, first_name TEXT, last_name TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    # -- Persistence --
+    def load(self):
+        try:
+            conn = self._connect()
+            try:
+                meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+                members = {row[0]: (row[1] or "", row[2] or "") for row in conn.execute("SELECT email_hash, first_name, last_name FROM members")}
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self._logger.warning(f"Could not load member index from {self._db_path}: {e}")
+            return
+        with self._lock:
+            self._members = members
+            self._permission_name = meta.get("permission_name")
+            self._synced_at = float(meta["synced_at"]) if meta.get("synced_at") else None
+        self._logger.info(f"Loaded member index: {len(members)} member(s) with '{self._permission_name}', synced {self.age_description()}.")
+
+    def replace(self, permission_name, members):
+        # members: iterable of (email, first_name, last_name); swaps the whole index in one transaction
+        rows = {}
+        for email, first_name, last_name in members:
+            if email:
+                rows[self.hash_email(email)] = (first_name or "", last_name or "")
+        synced_at = self._clock()
+        conn = self._connect()
+        try:
+            with conn: # Commits, or rolls back so a failed sync keeps the previous index
+                conn.execute("DELETE FROM members")
+                conn.executemany("INSERT INTO members (email_hash, first_name, last_name) VALUES (?, ?, ?)",
+                                 [(key, names[0], names[1]) for key, names in rows.items()])
+                conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 [("permission_name", permission_name), ("synced_at", repr(synced_at))])
+        finally:
+            conn.close()
+        with self._lock:
+            self._members = rows
+            self._permission_name = permission_name
+            self._synced_at = synced_at
+        return len(rows)
+
+    # -- Lookup --
+    def lookup(self, email, permission_name):
+        # Returns (first_name, last_name) for a member holding the permission, else None
+        with self._lock:
+            if permission_name != self._permission_name:
+                return None
+            return self._members.get(self.hash_email(email))
+
+    def age(self, permission_name):
+        # Seconds since the index for this permission was synced, or None if there is none
+        with self._lock:
+            if permission_name != self._permission_name or self._synced_at is None:
+                return None
+            return max(0.0, self._clock() - self._synced_at)
+
+    def age_description(self):
+        with self._lock:
+            synced_at = self._synced_at
+        return "never" if synced_at is None else time.ctime(synced_at)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._members)
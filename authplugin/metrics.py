@@ -0,0 +1,169 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds, spanning cache hits (ms) to a login against a struggling site
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    # Fixed-bucket latency histogram; observe() is a bisect and three increments under a private lock
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1) # Last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def percentile(self, fraction, counts=None, count=None):
+        # Estimated from the buckets by linear interpolation, like Prometheus' histogram_quantile
+        if counts is None:
+            counts, _, count = self.snapshot()
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if index == len(self.buckets): # +Inf bucket, the best we can say is "above the last bound"
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+# --- Auth Pipeline Metrics ---
+# Per-stage latency histograms and event counters for the authentication
+# flow, cheap enough to leave on permanently: no allocation per observation
+# and only a few increments under a short lock. Exposed as JSON through the
+# get_metrics API command and as Prometheus text through /metrics.
+# Startup phase timings are recorded once and survive reset().
+class Metrics(object):
+
+    STAGES = ("login", "permission_check", "materials_fetch", "job_note", "time_to_modal")
+    COUNTERS = ("authentications", "granted", "denied", "cancels", "network_errors",
+                "decision_cache_hits", "decision_cache_misses", "offline_decisions",
+                "circuit_rejections", "materials_downloads", "upstream_requests",
+                "preauthorizations", "preauth_hits", "holds", "hold_timeouts", "shared_cache_hits", "merged_requests",
+                "usage_parked")
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._histograms = {stage: Histogram() for stage in self.STAGES}
+        self._startup = OrderedDict() # phase -> seconds, in the order they ran
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, stage, seconds):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(stage, self._clock() - started)
+
+    def record_startup(self, phase, seconds):
+        with self._lock:
+            self._startup[phase] = seconds
+
+    @contextmanager
+    def startup_phase(self, phase):
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.record_startup(phase, self._clock() - started)
+
+    def startup_timings(self):
+        with self._lock:
+            return OrderedDict(self._startup)
+
+    def now(self):
+        # Start mark for observations that span threads (see since())
+        return self._clock()
+
+    def since(self, stage, started):
+        self.observe(stage, self._clock() - started)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        stages = {}
+        for stage, histogram in histograms.items():
+            counts, total, count = histogram.snapshot()
+            stages[stage] = dict(
+                count=count,
+                sum=total,
+                mean=total / count if count else None,
+                p50=histogram.percentile(0.5, counts, count),
+                p95=histogram.percentile(0.95, counts, count),
+                p99=histogram.percentile(0.99, counts, count)
+            )
+        return dict(since=self._started, counters=counters, stages=stages, startup=self.startup_timings())
+
+    def prometheus_text(self, prefix="printauth"):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        lines = []
+        for name in sorted(counters):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {counters[name]}")
+        metric = f"{prefix}_stage_duration_seconds"
+        lines.append(f"# HELP {metric} Time spent in each authentication stage.")
+        lines.append(f"# TYPE {metric} histogram")
+        for stage in sorted(histograms):
+            histogram = histograms[stage]
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (None,), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound is None else repr(bound)
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {count}')
+        startup = self.startup_timings()
+        if startup:
+            lines.append(f"# HELP {prefix}_startup_seconds Time spent in each plugin startup phase.")
+            lines.append(f"# TYPE {prefix}_startup_seconds gauge")
+            for phase, seconds in startup.items():
+                lines.append(f'{prefix}_startup_seconds{{phase="{phase}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self.COUNTERS, 0)
+            self._histograms = {stage: Histogram() for stage in self.STAGES}
+            self._started = time.time()
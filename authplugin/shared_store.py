@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# --- Shared Cache for OctoPrint Instances on One Host ---
+# Optional SQLite file (WAL mode) in a directory every instance can reach.
+# It holds the logged-in website session, permission decisions and materials
+# lists as JSON values with an expiry, plus short leases used to coalesce
+# identical lookups: the instance holding the lease asks makehaven.org, the
+# others wait for its answer to appear. Every method swallows SQLite errors
+# and reports a miss, so a missing or broken shared file only means falling
+# back to per-instance behaviour.
+class SharedStore(object):
+
+    FILENAME = "printauth_shared.db"
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, directory, logger, owner, clock=time.time):
+        self._db_path = os.path.join(directory, self.FILENAME)
+        self._logger = logger
+        self._owner = owner # Identifies this instance in leases
+        self._clock = clock # Wall clock, shared between processes
+        self._local = threading.local() # One connection per thread
+        self._init_db()
+
+    @property
+    def path(self):
+        return self._db_path
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=5, isolation_level=None) # Autocommit, explicit BEGIN below
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        # Raises OSError/sqlite3.Error so the plugin can fall back when the directory is unusable.
+        # The file holds a logged-in session cookie: it is created owner-only before SQLite opens
+        # it, and SQLite gives the -wal and -shm files it creates the same mode.
+        os.close(os.open(self._db_path, os.O_RDWR | os.O_CREAT, 0o600))
+        for path in (self._db_path, self._db_path + "-wal", self._db_path + "-shm"):
+            if os.path.exists(path):
+                os.chmod(path, 0o600) # Left readable by an older version
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    # -- Values --
+    def get(self, key):
+        # Returns (value, updated) or None when missing/expired
+        try:
+            row = self._connect().execute("SELECT value, expires, updated FROM entries WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self._logger.warning(f"Shared cache read failed for {key}: {e}")
+            return None
+        if row is None or row[1] <= self._clock():
+            return None
+        try:
+            return json.loads(row[0]), row[2]
+        except ValueError:
+            return None
+
+    def put(self, key, value, ttl):
+        if not ttl or ttl <= 0:
+            return False
+        now = self._clock()
+        try:
+            self._connect().execute("INSERT OR REPLACE INTO entries (key, value, expires, updated) VALUES (?, ?, ?, ?)",
+                                    (key, json.dumps(value), now + ttl, now))
+            return True
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self._logger.warning(f"Shared cache write failed for {key}: {e}")
+            return False
+
+    def delete(self, key=None, prefix=None):
+        # One key, every key with a prefix, or everything; returns the number of rows removed
+        try:
+            conn = self._connect()
+            if key is not None:
+                cursor = conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            elif prefix is not None:
+                cursor = conn.execute("DELETE FROM entries WHERE key LIKE ? ESCAPE '\\'",
+                                      (prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",))
+            else:
+                cursor = conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM entries WHERE expires <= ?", (self._clock(),)) # Housekeeping
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            self._logger.warning(f"Shared cache delete failed: {e}")
+            return 0
+
+    # -- Leases --
+    def acquire(self, key, ttl):
+        # True if this instance now holds the lease for key (or already did)
+        now = self._clock()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT owner, expires FROM leases WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] != self._owner and row[1] > now:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.execute("INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)", (key, self._owner, now + ttl))
+                conn.execute("COMMIT")
+                return True
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            self._logger.warning(f"Shared cache lease failed for {key}, not coalescing: {e}")
+            return True # Behave as if alone
+
+    def release(self, key):
+        try:
+            self._connect().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self._owner))
+        except sqlite3.Error as e:
+            self._logger.warning(f"Shared cache lease release failed for {key}: {e}")
+
+    def lease_held(self, key):
+        try:
+            row = self._connect().execute("SELECT expires FROM leases WHERE key = ? AND owner != ?", (key, self._owner)).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] > self._clock()
+
+    def coalesce(self, key, compute, lease_ttl=30, wait=20, fresh_after=None):
+        # Returns (value, shared) where shared is True if the value came from another instance.
+        # compute() returns (value, ttl); a falsy ttl keeps the value out of the store (errors).
+        # fresh_after: ignore stored values updated before this wall-clock time.
+        deadline = self._clock() + wait
+        while True:
+            entry = self.get(key)
+            if entry is not None and (fresh_after is None or entry[1] >= fresh_after):
+                return entry[0], True
+            if self.acquire(key, lease_ttl):
+                try:
+                    value, ttl = compute()
+                    self.put(key, value, ttl)
+                    return value, False
+                finally:
+                    self.release(key)
+            # Another instance is asking makehaven.org right now; wait for its answer
+            while self.lease_held(key) and self._clock() < deadline:
+                time.sleep(self.POLL_INTERVAL)
+            if self._clock() >= deadline:
+                self._logger.info(f"Gave up waiting for another instance to fetch {key}, fetching it here.")
+                value, ttl = compute()
+                self.put(key, value, ttl)
+                return value, False
+            # Lease released (or expired): loop to pick up the value, or take over if it failed
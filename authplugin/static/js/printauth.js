@@ -1,6 +1,8 @@
 $(function() {
-    function PrintAuthViewModel() {
+    function PrintAuthViewModel(parameters) {
         var self = this;
+        self.settings = parameters[0];
+        self.files = parameters[1];
 
         // --- Helper Function to Show Modal ---
         self.showMaterialModal = function(data) {
@@ -36,11 +38,201 @@ $(function() {
              $("#printAuthMaterialModal").modal({ backdrop: 'static', keyboard: false });
         }; // End showMaterialModal
 
+        // --- Helper Function to Handle an Authentication Result ---
+        self.handleAuthResult = function(response) {
+            if (response.success) {
+                self.showMaterialModal(response);
+            } else {
+                // Keep differentiated error alerts
+                var message = response.message || "Unknown authentication error.";
+                if (message.includes("credentials failed") || message.includes("Plugin settings error")) {
+                     alert("Configuration Error:\nCould not log into authentication service or plugin settings are incomplete.\nPlease check settings or notify MakeHaven staff.");
+                } else if (message.includes("Network error") || message.includes("timed out")) {
+                     alert("Network Error:\nCould not contact authentication service.\nPlease check network or notify MakeHaven staff.");
+                } else if (message.includes("Permission denied") || message.includes("not found") || message.includes("lacks required permission") || message.includes("not granted")) {
+                     alert("Authentication Failed:\n" + message + "\nPlease check email address or contact MakeHaven staff.");
+                } else {
+                     alert("Authentication Failed:\n" + message);
+                }
+            }
+        }; // End handleAuthResult
+
+        // --- Async Authenticate: Pending Request Tracking ---
+        self.pendingAuthRequestId = null;
+        // auth_result and preauth_result pushes can beat the HTTP response that tells us our
+        // request_id or token (cache hits finish in about a millisecond), so unmatched ones are
+        // kept until the id is known
+        self.unclaimedResults = {};
+        self.unclaimedOrder = [];
+
+        self.keepUnclaimedResult = function(id, result) {
+            self.unclaimedResults[id] = result;
+            self.unclaimedOrder.push(id);
+            while (self.unclaimedOrder.length > 20) { // Results meant for other clients
+                delete self.unclaimedResults[self.unclaimedOrder.shift()];
+            }
+        };
+
+        self.takeUnclaimedResult = function(id) {
+            var result = self.unclaimedResults[id];
+            delete self.unclaimedResults[id];
+            return result;
+        };
+
+        self.setPendingAuth = function(requestId) {
+            var early = self.takeUnclaimedResult(requestId);
+            if (early) {
+                self.handleAuthResult(early);
+                return;
+            }
+            self.pendingAuthRequestId = requestId;
+        };
+
+        self.checkPendingAuth = function() {
+            // Recover a result pushed while this client was disconnected
+            if (!self.pendingAuthRequestId) return;
+            $.ajax({
+                url: API_BASEURL + "plugin/print_auth_plugin",
+                type: "POST",
+                dataType: "json",
+                contentType: "application/json",
+                data: JSON.stringify({ command: "auth_status", request_id: self.pendingAuthRequestId }),
+                success: function(response) {
+                    if (response.request_id === self.pendingAuthRequestId && response.state === "done" && response.result) {
+                        self.pendingAuthRequestId = null;
+                        self.handleAuthResult(response.result);
+                    }
+                },
+                error: function(jqXHR, textStatus, errorThrown) {
+                    console.error("AJAX Error (Auth Status):", textStatus, errorThrown, jqXHR.responseText);
+                    if (jqXHR.status === 404) self.pendingAuthRequestId = null; // Server restarted, request is gone
+                }
+            });
+        };
+
+        self.onDataUpdaterReconnect = function() {
+            self.checkPendingAuth();
+        };
+
+        // --- Pre-Authorization at File Selection ---
+        self.pendingPreauthToken = null;
+
+        self.preauthorizeEnabled = function() {
+            var plugin = self.settings.settings.plugins.print_auth_plugin;
+            return plugin && plugin.preauthorize_enabled && plugin.preauthorize_enabled();
+        };
+
+        self.onStartup = function() {
+            // Ask only in the browser where the file was loaded. "Load and Print" starts the
+            // print right away, so the PrintStarted prompt covers it.
+            var loadFile = self.files.loadFile;
+            self.files.loadFile = function(data, printAfterLoad) {
+                var result = loadFile.apply(self.files, arguments);
+                if (data && data.path && !printAfterLoad && self.preauthorizeEnabled()) {
+                    self.requestPreauthorization({origin: data.origin, path: data.path, name: data.display || data.name || data.path});
+                }
+                return result;
+            };
+        };
+
+        self.requestPreauthorization = function(file) {
+            var email = prompt("Pre-authorize printing " + file.name + "?\nEnter your MakeHaven email now, or Cancel to authenticate when the print starts:");
+            if (!email) return;
+            $.ajax({
+                url: API_BASEURL + "plugin/print_auth_plugin",
+                type: "POST",
+                dataType: "json",
+                contentType: "application/json",
+                data: JSON.stringify({ command: "preauthorize", email: email, origin: file.origin, path: file.path }),
+                success: function(response) {
+                    new PNotify({title: 'Print Authentication', text: response.message, type: 'info', delay: 3000});
+                    var early = self.takeUnclaimedResult(response.token);
+                    if (early) {
+                        self.handlePreauthResult(early);
+                    } else {
+                        self.pendingPreauthToken = response.token;
+                    }
+                },
+                error: function(jqXHR, textStatus, errorThrown) {
+                    console.error("AJAX Error (Preauthorize):", textStatus, errorThrown, jqXHR.responseText);
+                    new PNotify({title: 'Print Authentication', text: 'Could not pre-authorize, you will be asked again when the print starts.', type: 'error', delay: 5000});
+                }
+            });
+        };
+
+        self.handlePreauthResult = function(result) {
+            if (result.success) {
+                new PNotify({title: 'Print Pre-Authorized', text: result.message + ". Start the print to confirm materials.", type: 'success', delay: 8000});
+            } else {
+                new PNotify({title: 'Pre-Authorization Failed', text: result.message + "\nYou will be asked again when the print starts.", type: 'error', delay: 10000});
+            }
+        };
+
+        // --- Auth Service Status (circuit breaker) ---
+        self.serviceStatus = null;
+
+        self.updateServiceStatus = function(status) {
+            var wasDown = self.serviceStatus && self.serviceStatus.state === "open";
+            var isDown = status.state === "open";
+            self.serviceStatus = status;
+            if (isDown && !wasDown) {
+                new PNotify({title: 'Print Authentication', text: 'Auth service down: MakeHaven website is not responding.', type: 'error', delay: 10000});
+            } else if (wasDown && status.state === "closed") {
+                new PNotify({title: 'Print Authentication', text: 'Auth service reachable again.', type: 'success', delay: 5000});
+            }
+        };
+
         // --- Main Message Handler ---
         self.onDataUpdaterPluginMessage = function(plugin, data) {
             console.log("onDataUpdaterPluginMessage received:", plugin, data);
 
+            if (plugin === "print_auth_plugin" && data.auth_result) {
+                // Outcome of an async authenticate; only the client that submitted it reacts
+                if (data.auth_result.request_id === self.pendingAuthRequestId) {
+                    self.pendingAuthRequestId = null;
+                    self.handleAuthResult(data.auth_result);
+                } else {
+                    self.keepUnclaimedResult(data.auth_result.request_id, data.auth_result);
+                }
+                return;
+            }
+
+            if (plugin === "print_auth_plugin" && data.preauth_result) {
+                // Only the client that asked reports the outcome
+                if (data.preauth_result.token === self.pendingPreauthToken) {
+                    self.pendingPreauthToken = null;
+                    self.handlePreauthResult(data.preauth_result);
+                } else {
+                    self.keepUnclaimedResult(data.preauth_result.token, data.preauth_result);
+                }
+                return;
+            }
+
+            if (plugin === "print_auth_plugin" && data.preauthorized) {
+                // PrintStarted matched a pre-authorization: no email prompt, straight to materials
+                self.handleAuthResult(data.preauthorized);
+                return;
+            }
+
+            if (plugin === "print_auth_plugin" && data.hold_timeout) {
+                $("#printAuthMaterialModal").modal('hide');
+                new PNotify({title: 'Print Cancelled', text: data.hold_timeout.message, type: 'error', hide: false});
+                return;
+            }
+
+            if (plugin === "print_auth_plugin" && data.service_status) {
+                self.updateServiceStatus(data.service_status);
+                return;
+            }
+
             if (plugin === "print_auth_plugin" && data.prompt) {
+                if (data.service) {
+                    self.updateServiceStatus(data.service);
+                    if (data.service.state === "open") {
+                        // Tell the member now rather than after the request fails
+                        new PNotify({title: 'Print Authentication', text: 'Auth service down. Authentication may fail unless an offline member list is configured.', type: 'error', delay: 10000});
+                    }
+                }
                 var email = prompt("Please enter your MakeHaven email for authentication:");
                 if (email) {
                     $.ajax({
@@ -50,20 +242,12 @@ $(function() {
                         contentType: "application/json",
                         data: JSON.stringify({ command: "authenticate", email: email }),
                         success: function(response) {
-                            if (response.success) {
-                                self.showMaterialModal(response);
+                            if (response.pending) {
+                                // Async mode: the result arrives later as an auth_result plugin message
+                                new PNotify({title: 'Print Authentication', text: response.message, type: 'info', delay: 3000});
+                                self.setPendingAuth(response.request_id);
                             } else {
-                                // Keep differentiated error alerts
-                                var message = response.message || "Unknown authentication error.";
-                                if (message.includes("credentials failed") || message.includes("Plugin settings error")) {
-                                     alert("Configuration Error:\nCould not log into authentication service or plugin settings are incomplete.\nPlease check settings or notify MakeHaven staff.");
-                                } else if (message.includes("Network error") || message.includes("timed out")) {
-                                     alert("Network Error:\nCould not contact authentication service.\nPlease check network or notify MakeHaven staff.");
-                                } else if (message.includes("Permission denied") || message.includes("not found") || message.includes("lacks required permission") || message.includes("not granted")) {
-                                     alert("Authentication Failed:\n" + message + "\nPlease check email address or contact MakeHaven staff.");
-                                } else {
-                                     alert("Authentication Failed:\n" + message);
-                                }
+                                self.handleAuthResult(response);
                             }
                         },
                         error: function(jqXHR, textStatus, errorThrown) {
@@ -108,12 +292,30 @@ $(function() {
             });
         }); // End button click handlers
 
+        // --- Settings: Clear Permission Cache ---
+        $(document).off('click', '#printAuthBtnClearCache').on('click', '#printAuthBtnClearCache', function() {
+            $.ajax({
+                url: API_BASEURL + "plugin/print_auth_plugin",
+                type: "POST",
+                dataType: "json",
+                contentType: "application/json",
+                data: JSON.stringify({ command: "clear_auth_cache" }),
+                success: function(response) {
+                    new PNotify({title: 'Permission Cache', text: response.message, type: 'success', delay: 5000});
+                },
+                error: function(jqXHR, textStatus, errorThrown) {
+                    console.error("AJAX Error (Clear Cache):", textStatus, errorThrown, jqXHR.responseText);
+                    new PNotify({title: 'Communication Error', text: 'Error clearing the permission cache.', type: 'error', delay: 5000});
+                }
+            });
+        });
+
     } // End of PrintAuthViewModel
 
     // Register the ViewModel (Simplified Version)
     OCTOPRINT_VIEWMODELS.push([
         PrintAuthViewModel,
-        [], // No Dependencies
+        ["settingsViewModel", "filesViewModel"],
         []  // No Specific Elements to bind to
     ]);
     console.log("PrintAuthViewModel registered.");
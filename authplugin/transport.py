@@ -0,0 +1,168 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from concurrent.futures import Future
+
+import requests
+from requests.cookies import get_cookie_header
+from requests.structures import CaseInsensitiveDict
+
+
+# --- Upstream HTTP Transports ---
+# ApiSession hands every GET to a transport. Both transports take the
+# logged-in requests.Session (headers and cookies come from it, so login and
+# session sharing work unchanged) and return a requests.Response. Errors are
+# raised as requests exceptions, so callers don't care which one is in use.
+#
+#  - RequestsTransport: the session itself, the default and the fallback.
+#  - HttpxTransport: an httpx.AsyncClient on its own event loop thread, with
+#    a warm connection pool and HTTP/2 when the h2 package is installed and
+#    the server supports it. Needs the optional httpx dependency.
+class RequestsTransport(object):
+
+    name = "requests"
+
+    def get(self, session, url, **kwargs):
+        return session.get(url, **kwargs)
+
+    def close(self):
+        pass
+
+
+class HttpxTransport(object):
+
+    name = "httpx"
+
+    def __init__(self, logger, pool_size=4):
+        import httpx # Optional dependency; ImportError tells the caller to fall back
+        import asyncio # Only needed here, and slow to import on a Pi
+        self._httpx = httpx
+        self._asyncio = asyncio
+        self._logger = logger
+        self.pool_size = pool_size
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="PrintAuthHttpx")
+        self._thread.daemon = True
+        self._thread.start()
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        try:
+            self._client = self._call(self._make_client(limits, http2=True))
+            self.http2 = True
+        except ImportError: # httpx without the h2 extra
+            self._client = self._call(self._make_client(limits, http2=False))
+            self.http2 = False
+        logger.info(f"Using httpx transport (HTTP/2 {'available' if self.http2 else 'unavailable, install httpx[http2]'}).")
+
+    async def _make_client(self, limits, http2):
+        # Created on the loop thread, where it will be used
+        return self._httpx.AsyncClient(http2=http2, limits=limits, follow_redirects=True)
+
+    def _call(self, coroutine):
+        return self._asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def submit(self, session, url, **kwargs):
+        # Starts the request on the event loop and returns a concurrent.futures.Future
+        return self._asyncio.run_coroutine_threadsafe(self._get(session, url, **kwargs), self._loop)
+
+    def get(self, session, url, **kwargs):
+        return self.submit(session, url, **kwargs).result()
+
+    async def _get(self, session, url, params=None, headers=None, timeout=None, **kwargs):
+        httpx = self._httpx
+        request_headers = dict(session.headers)
+        request_headers.update(headers or {})
+        cookie = get_cookie_header(session.cookies, requests.Request("GET", url))
+        if cookie:
+            request_headers["Cookie"] = cookie
+        try:
+            response = await self._client.get(url, params=params, headers=request_headers, timeout=self._timeout(timeout))
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(str(e) or "Connect timeout")
+        except (httpx.ReadTimeout, httpx.WriteTimeout, httpx.PoolTimeout) as e:
+            raise requests.exceptions.ReadTimeout(str(e) or "Read timeout")
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e) or "Timeout")
+        except httpx.TransportError as e: # Connect errors, protocol errors, dropped connections
+            raise requests.exceptions.ConnectionError(str(e) or type(e).__name__)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e) or type(e).__name__)
+        if response.cookies:
+            session.cookies.update(response.cookies.jar) # Keep refreshed cookies, as Session.get would
+        return self._to_requests_response(response)
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self._httpx.Timeout(None)
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self._httpx.Timeout(read, connect=connect)
+        return self._httpx.Timeout(timeout)
+
+    @staticmethod
+    def _to_requests_response(response):
+        converted = requests.Response()
+        converted.status_code = response.status_code
+        converted._content = response.content
+        converted.headers = CaseInsensitiveDict(response.headers)
+        converted.url = str(response.url)
+        converted.encoding = response.encoding
+        converted.reason = response.reason_phrase
+        converted.elapsed = response.elapsed
+        return converted
+
+    def close(self):
+        try:
+            self._call(self._client.aclose())
+        except Exception as e:
+            self._logger.debug(f"Error closing httpx client: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=2)
+        if not self._thread.is_alive():
+            self._loop.close()
+
+
+def create_transport(name, logger, pool_size=4):
+    # Falls back to requests when httpx isn't installed
+    if name == "httpx":
+        try:
+            return HttpxTransport(logger, pool_size)
+        except ImportError:
+            logger.warning("httpx transport selected but httpx is not installed (pip install httpx[http2]), using requests.")
+    return RequestsTransport()
+
+
+# --- In-Flight Request Merging ---
+# Identical requests that overlap in time share one upstream call: the first
+# caller performs it and everyone who asks for the same key meanwhile gets
+# the same result (or exception). Nothing is cached after the call ends.
+class InflightRequests(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> Future
+
+    def run(self, key, call):
+        # Returns (result, merged) where merged is True if another caller's request was reused
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._inflight)
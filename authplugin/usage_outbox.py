@@ -0,0 +1,139 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import sqlite3
+import threading
+import time
+
+
+# --- Durable Usage Note Outbox ---
+# Every authorized print's usage record (note, tool name, material choice) is
+# appended to a small SQLite table in WAL mode as soon as the print is
+# authorized, and delivered to the API by a background flusher, off the
+# interactive path. A record still waiting for its material choice or its
+# filament estimate is stored but not delivered until it is complete.
+# Entries are only deleted after the API has accepted them, so a crash,
+# restart or outage never loses a billing record. A record the API keeps
+# rejecting is parked after a number of attempts: it stays in the table for
+# staff to look at, but no longer takes a place in delivery batches.
+class UsageOutbox(object):
+
+    COLUMNS = ("id", "created", "email", "note", "tool_name", "material_choice", "attempts")
+
+    def __init__(self, db_path, logger, clock=time.time):
+        self._db_path = db_path
+        self._logger = logger
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self._db_path, timeout=10)
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                email TEXT NOT NULL,
+                note TEXT,
+                tool_name TEXT,
+                material_choice TEXT,
+                awaiting_material INTEGER NOT NULL DEFAULT 0,
+                awaiting_estimate INTEGER NOT NULL DEFAULT 0,
+                parked INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT)""")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def enqueue(self, email, note, tool_name=None, material_choice=None, awaiting_material=False, awaiting_estimate=False):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    cursor = conn.execute("INSERT INTO outbox (created, email, note, tool_name, material_choice, awaiting_material, awaiting_estimate) "
+                                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          (self._clock(), email, note, tool_name, material_choice,
+                                           1 if awaiting_material else 0, 1 if awaiting_estimate else 0))
+                    return cursor.lastrowid
+            finally:
+                conn.close()
+
+    def set_material(self, entry_id, material_choice):
+        self._execute("UPDATE outbox SET material_choice = ?, awaiting_material = 0 WHERE id = ?", (material_choice, entry_id))
+
+    def set_note(self, entry_id, note):
+        # The note with its filament estimate filled in
+        self._execute("UPDATE outbox SET note = ?, awaiting_estimate = 0 WHERE id = ?", (note, entry_id))
+
+    def discard(self, entry_id):
+        # A record for a print that never ran
+        self._execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def release_incomplete(self):
+        # At startup: records of prints interrupted by a restart are delivered as they are,
+        # without a material choice ("unconfirmed") or estimate. Returns how many.
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    return conn.execute("UPDATE outbox SET material_choice = CASE WHEN awaiting_material THEN 'unconfirmed' ELSE material_choice END, "
+                                        "awaiting_material = 0, awaiting_estimate = 0 WHERE awaiting_material OR awaiting_estimate").rowcount
+            finally:
+                conn.close()
+
+    def pending(self, limit=50):
+        # Complete records, as dicts: never tried before retried, then oldest first
+        with self._lock:
+            conn = self._connect()
+            try:
+                rows = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM outbox WHERE awaiting_material = 0 AND awaiting_estimate = 0 "
+                                    f"AND parked = 0 ORDER BY attempts, id LIMIT ?", (limit,)).fetchall()
+            finally:
+                conn.close()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def ack(self, entry_id):
+        self._execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def mark_failed(self, entry_id, error, max_attempts=None):
+        # Counts a rejected delivery; returns True if the record is now parked
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute("UPDATE outbox SET attempts = attempts + 1, last_error = ?, "
+                                 "parked = CASE WHEN ? AND attempts + 1 >= ? THEN 1 ELSE 0 END WHERE id = ?",
+                                 (str(error)[:500], 1 if max_attempts else 0, max_attempts or 0, entry_id))
+                    row = conn.execute("SELECT parked FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+                    return bool(row and row[0])
+            finally:
+                conn.close()
+
+    def count(self):
+        # Records still to be delivered, parked ones excluded
+        return self._count("SELECT COUNT(*) FROM outbox WHERE parked = 0")
+
+    def parked_count(self):
+        return self._count("SELECT COUNT(*) FROM outbox WHERE parked = 1")
+
+    def _count(self, sql):
+        with self._lock:
+            conn = self._connect()
+            try:
+                return conn.execute(sql).fetchone()[0]
+            finally:
+                conn.close()
+
+    def _execute(self, sql, params):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            finally:
+                conn.close()
@@ -0,0 +1,184 @@
+# coding=utf-8
+"""Concurrent authenticate / confirm_material load test.
+
+Starts the stub MakeHaven API, creates one PrintAuthPlugin instance per
+simulated printer and has every printer run print cycles in parallel:
+PrintStarted, the member "typing" their email, authenticate, then
+confirm_material and PrintDone. Reports p50/p95/p99 time-to-decision,
+throughput, outcomes and how many requests reached the upstream API.
+
+Example::
+
+    python -m benchmarks.bench_auth --printers 8 --rounds 20 --latency 0.2 --error-rate 0.05
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import flask
+
+from .host import make_plugin
+from .stub_server import StubConfig, StubMakeHaven
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+def call_command(app, plugin, command, data):
+    # on_api_command needs an app context for flask.jsonify, as it has inside OctoPrint
+    with app.test_request_context():
+        response = plugin.on_api_command(command, dict(data, command=command))
+        status = 200
+        if isinstance(response, tuple):
+            response, status = response
+        return response.get_json(), status
+
+
+class PrinterRunner(object):
+
+    def __init__(self, app, plugin, args, rng, barrier):
+        self.app = app
+        self.plugin = plugin
+        self.args = args
+        self.rng = rng
+        self.barrier = barrier
+        self.decisions = []
+        self.confirms = []
+        self.outcomes = Counter()
+
+    def pick_email(self):
+        if self.rng.random() < self.args.deny_fraction:
+            return f"nonmember{self.rng.randrange(self.args.members)}@example.org"
+        return f"member{self.rng.randrange(self.args.members)}@example.org"
+
+    def run(self):
+        self.barrier.wait()
+        for _ in range(self.args.rounds):
+            self.plugin.on_event("PrintStarted", {"name": "bench.gcode", "path": "bench.gcode", "origin": "local"})
+            if self.args.think:
+                time.sleep(self.rng.uniform(0, self.args.think)) # Member typing their email
+
+            started = time.perf_counter()
+            result, _ = call_command(self.app, self.plugin, "authenticate", {"email": self.pick_email()})
+            if result.get("pending"):
+                result = self.plugin._plugin_manager.wait_for_result(result["request_id"]) or {"success": False, "message": "timeout"}
+            self.decisions.append(time.perf_counter() - started)
+
+            if result.get("success"):
+                self.outcomes["granted" if not result.get("offline") else "granted_offline"] += 1
+                started = time.perf_counter()
+                call_command(self.app, self.plugin, "confirm_material", {"choice": "own_material"})
+                self.confirms.append(time.perf_counter() - started)
+                self.plugin.on_event("PrintDone", {})
+            elif "Network error" in result.get("message", ""):
+                self.outcomes["network_error"] += 1
+                self.plugin.on_event("PrintFailed", {})
+            else:
+                self.outcomes["denied"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the print authentication flow against a local API stand-in.")
+    parser.add_argument("--printers", type=int, default=4, help="simulated printers (plugin instances) running in parallel")
+    parser.add_argument("--rounds", type=int, default=10, help="print cycles per printer")
+    parser.add_argument("--members", type=int, default=20, help="distinct member emails to draw from")
+    parser.add_argument("--deny-fraction", type=float, default=0.1, help="fraction of attempts by non-members")
+    parser.add_argument("--think", type=float, default=0.2, help="max seconds between PrintStarted and authenticate")
+    parser.add_argument("--latency", type=float, default=0.1, help="mean upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="+/- upstream latency noise in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream API requests failing with 503")
+    parser.add_argument("--session-ttl", type=float, default=0.0, help="seconds before upstream logins expire (0 = never)")
+    parser.add_argument("--async", dest="async_auth", action="store_true", help="use the non-blocking authenticate mode")
+    parser.add_argument("--no-cache", action="store_true", help="disable the permission decision cache")
+    parser.add_argument("--offline", choices=("off", "fallback", "primary"), default="off", help="offline authorization mode")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show plugin log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format="%(threadName)s %(levelname)s %(name)s: %(message)s")
+
+    stub = StubMakeHaven(StubConfig(args.latency, args.jitter, args.error_rate, args.session_ttl, seed=args.seed)).start()
+    work_dir = tempfile.mkdtemp(prefix="printauth-bench-")
+    gcode_path = os.path.join(work_dir, "bench.gcode")
+    with open(gcode_path, "w") as f:
+        f.write("G21\nG90\nM82\nG92 E0\nG1 X10 Y10 E5.0\nG1 X20 Y20 E12.5\n")
+    metadata = {"bench.gcode": {"analysis": {"filament": {"tool0": {"length": 12.5, "volume": 0.03}}}}}
+    overrides = dict(async_authenticate=args.async_auth, decision_cache_enabled=not args.no_cache,
+                     offline_auth_mode=args.offline)
+
+    app = flask.Flask("printauth_bench")
+    rng = random.Random(args.seed)
+    plugins, runners = [], []
+    barrier = threading.Barrier(args.printers)
+    try:
+        for index in range(args.printers):
+            plugin = make_plugin(stub.base_url, os.path.join(work_dir, f"printer{index}"), work_dir, "bench.gcode",
+                                 overrides, metadata, name=f"printer{index}")
+            plugin.on_startup("127.0.0.1", 5000)
+            plugins.append(plugin)
+            runners.append(PrinterRunner(app, plugin, args, random.Random(rng.random()), barrier))
+        if args.offline != "off":
+            for plugin in plugins:
+                plugin._sync_member_index()
+        stub.reset_counts() # Count the print cycles only, not startup and roster syncs
+
+        threads = [threading.Thread(target=runner.run, name=f"BenchPrinter{i}") for i, runner in enumerate(runners)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        # Give the usage outboxes a moment to deliver, so the note traffic is part of the count
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(plugin._usage_outbox.count() for plugin in plugins):
+            time.sleep(0.1)
+        undelivered = sum(plugin._usage_outbox.count() for plugin in plugins)
+    finally:
+        for plugin in plugins:
+            plugin.on_shutdown()
+        stub.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    decisions = [sample for runner in runners for sample in runner.decisions]
+    confirms = [sample for runner in runners for sample in runner.confirms]
+    outcomes = sum((runner.outcomes for runner in runners), Counter())
+    upstream = dict(stub.counts)
+
+    print(f"\nPrint authentication benchmark: {args.printers} printer(s) x {args.rounds} round(s), "
+          f"upstream latency {args.latency * 1000:.0f}+/-{args.jitter * 1000:.0f}ms, error rate {args.error_rate:.0%}, "
+          f"session TTL {args.session_ttl or 'none'}, {'async' if args.async_auth else 'sync'} authenticate, "
+          f"cache {'off' if args.no_cache else 'on'}, offline {args.offline}")
+    print(f"{'':18}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for label, samples in (("time-to-decision", decisions), ("confirm_material", confirms)):
+        print(f"{label:18}{len(samples):>8}{format_ms(percentile(samples, 0.5)):>10}{format_ms(percentile(samples, 0.95)):>10}"
+              f"{format_ms(percentile(samples, 0.99)):>10}{format_ms(max(samples) if samples else None):>10}")
+    print(f"throughput: {len(decisions) / elapsed:.1f} decisions/s over {elapsed:.1f}s "
+          f"(includes up to {args.think * 1000:.0f}ms think time per cycle)")
+    print(f"outcomes: {dict(outcomes)}")
+    total_upstream = sum(upstream.values())
+    print(f"upstream requests: {total_upstream} ({total_upstream / max(1, len(decisions)):.2f} per decision) {upstream}")
+    if undelivered:
+        print(f"usage records still in outboxes: {undelivered}")
+
+
+if __name__ == "__main__":
+    main()
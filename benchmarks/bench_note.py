@@ -0,0 +1,100 @@
+# coding=utf-8
+"""Job note construction benchmark for large G-code files.
+
+Generates a synthetic multi-tool G-code file (retractions, G92 resets,
+relative extrusion sections) and times how long the usage note takes to
+build: with OctoPrint's analysis in the metadata, with the streaming
+estimator on a cold cache, and again once the estimate is cached.
+
+Example::
+
+    python -m benchmarks.bench_note --size-mb 300
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from authplugin.gcode_estimator import scan_extrusion
+
+from .host import make_plugin
+
+
+def write_gcode(path, size_mb):
+    # Slicer-like moves; about 40 bytes per line
+    target = size_mb * 1024 * 1024
+    layer = 0
+    with open(path, "w") as f:
+        f.write("; generated by benchmarks.bench_note\nG21\nG90\nM82\nT0\nG92 E0\n")
+        while f.tell() < target:
+            layer += 1
+            lines = []
+            e = 0.0
+            for i in range(2000):
+                e += 0.04
+                lines.append(f"G1 X{100 + (i % 50) * 0.5:.3f} Y{100 + (i // 50) * 0.5:.3f} E{e:.5f}\n")
+            lines.append(f"G1 E{e - 0.8:.5f} F2400 ; retract\nG1 Z{layer * 0.2:.2f}\nG1 E{e:.5f}\nG92 E0\n")
+            if layer % 10 == 0: # Second extruder in relative mode now and then
+                lines.append("T1\nM83\n" + "G1 X120 Y120 E0.05\n" * 200 + "M82\nG92 E0\nT0\nG92 E0\n")
+            f.writelines(lines)
+    return os.path.getsize(path)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    value = func(*args)
+    return time.perf_counter() - started, value
+
+
+def max_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024.0 # kB on Linux
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark usage note construction for large G-code files.")
+    parser.add_argument("--size-mb", type=int, default=100, help="size of the generated G-code file")
+    parser.add_argument("--keep", action="store_true", help="keep the generated file and print its path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    work_dir = tempfile.mkdtemp(prefix="printauth-note-bench-")
+    gcode_path = os.path.join(work_dir, "large.gcode")
+    try:
+        print(f"Generating {args.size_mb} MB of G-code...")
+        size = write_gcode(gcode_path, args.size_mb)
+        rss_before = max_rss_mb()
+
+        scan_time, lengths = timed(scan_extrusion, gcode_path)
+        print(f"raw scan: {scan_time:.2f}s, {size / scan_time / 1024 / 1024:.1f} MB/s, "
+              f"peak RSS +{max_rss_mb() - rss_before:.1f} MB, per tool {({tool: round(length, 1) for tool, length in lengths.items()})}")
+
+        analysed = {"large.gcode": {"analysis": {"filament": {"tool0": {"length": 1234.5, "volume": 2.9}}}}}
+        with_analysis = make_plugin("http://127.0.0.1:9", os.path.join(work_dir, "data-analysis"), work_dir, "large.gcode", metadata=analysed)
+        with_analysis.on_startup("127.0.0.1", 5000)
+        without_analysis = make_plugin("http://127.0.0.1:9", os.path.join(work_dir, "data-estimate"), work_dir, "large.gcode")
+        without_analysis.on_startup("127.0.0.1", 5000)
+        try:
+            job = with_analysis._printer.get_current_job()
+            for label, plugin in (("note from analysis", with_analysis),
+                                  ("note, cold estimate", without_analysis),
+                                  ("note, cached estimate", without_analysis)):
+                elapsed, note = timed(plugin._build_job_note, job)
+                print(f"{label:24}{elapsed * 1000:>10.1f}ms  {note}")
+        finally:
+            with_analysis.on_shutdown()
+            without_analysis.on_shutdown()
+        if args.keep:
+            print(f"G-code kept at {gcode_path}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
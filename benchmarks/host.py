@@ -0,0 +1,129 @@
+# coding=utf-8
+"""Minimal stand-ins for the OctoPrint objects a PrintAuthPlugin instance uses.
+
+Each benchmark "printer" is one plugin instance wired to these, the same
+way OctoPrint injects _settings, _printer, _file_manager and friends.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+
+from authplugin import PrintAuthPlugin
+
+
+class BenchSettings(object):
+    # Dict-backed subset of octoprint.plugin.PluginSettings
+
+    def __init__(self, defaults, overrides=None):
+        self._values = dict(defaults)
+        self._values.update(overrides or {})
+
+    def get(self, path, **kwargs):
+        return self._values.get(path[0])
+
+    def get_boolean(self, path, **kwargs):
+        value = self._values.get(path[0])
+        if isinstance(value, str):
+            return value.lower() in ("true", "yes", "y", "1", "on")
+        return bool(value)
+
+    def get_int(self, path, **kwargs):
+        value = self._values.get(path[0])
+        return None if value in (None, "") else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self._values.get(path[0])
+        return None if value in (None, "") else float(value)
+
+    def set(self, path, value, **kwargs):
+        self._values[path[0]] = value
+
+
+class BenchPrinter(object):
+
+    def __init__(self, path, origin="local"):
+        self.job = {"file": {"path": path, "origin": origin, "display": os.path.basename(path)}}
+        self.cancelled = 0
+        self.paused = 0
+        self.resumed = 0
+        self.on_hold = 0
+        self.sent = []
+
+    def get_current_job(self):
+        return self.job
+
+    def cancel_print(self, *args, **kwargs):
+        self.cancelled += 1
+
+    def pause_print(self, *args, **kwargs):
+        self.paused += 1
+
+    def resume_print(self, *args, **kwargs):
+        self.resumed += 1
+
+    def set_job_on_hold(self, value, blocking=True, *args, **kwargs):
+        self.on_hold = max(0, self.on_hold + (1 if value else -1))
+
+    def commands(self, commands, *args, **kwargs):
+        self.sent.extend(commands if isinstance(commands, (list, tuple)) else [commands])
+
+
+class BenchFileManager(object):
+
+    def __init__(self, base_folder, metadata=None):
+        self._base_folder = base_folder
+        self._metadata = metadata or {}
+
+    def get_metadata(self, origin, path):
+        return self._metadata.get(path, {})
+
+    def path_on_disk(self, origin, path):
+        return os.path.join(self._base_folder, path)
+
+
+class BenchPluginManager(object):
+    # Records plugin messages; waiters can block until an async auth_result arrives
+
+    def __init__(self):
+        self.messages = []
+        self._results = {}
+        self._condition = threading.Condition()
+
+    def send_plugin_message(self, identifier, data):
+        with self._condition:
+            self.messages.append(data)
+            result = data.get("auth_result") if isinstance(data, dict) else None
+            if result:
+                self._results[result.get("request_id")] = result
+                self._condition.notify_all()
+
+    def wait_for_result(self, request_id, timeout=60):
+        with self._condition:
+            self._condition.wait_for(lambda: request_id in self._results, timeout)
+            return self._results.pop(request_id, None)
+
+
+def make_plugin(base_url, data_folder, gcode_folder, gcode_path, overrides=None, metadata=None, name="printer"):
+    # One plugin instance (= one printer) pointed at the stub server
+    plugin = PrintAuthPlugin()
+    plugin._identifier = "print_auth_plugin"
+    plugin._logger = logging.getLogger(f"octoprint.plugins.print_auth_plugin.{name}")
+    settings = dict(
+        login_url=f"{base_url}/user/login",
+        username="bench",
+        password="bench",
+        permission_check_url_template=f"{base_url}/api/v0/email/{{email}}/permission/{{permission}}",
+        member_roster_url_template=f"{base_url}/api/v0/roster/{{permission}}",
+        materials_url_template=f"{base_url}/api/v0/materials/equipment/{{tool_id}}",
+        session_keepalive_interval=0,
+    )
+    settings.update(overrides or {})
+    plugin._settings = BenchSettings(plugin.get_settings_defaults(), settings)
+    plugin._printer = BenchPrinter(gcode_path)
+    plugin._file_manager = BenchFileManager(gcode_folder, metadata)
+    plugin._plugin_manager = BenchPluginManager()
+    plugin._data_folder = data_folder
+    os.makedirs(data_folder, exist_ok=True)
+    return plugin
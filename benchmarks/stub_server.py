@@ -0,0 +1,206 @@
+# coding=utf-8
+"""Local stand-in for the parts of makehaven.org the plugin talks to.
+
+Serves the Drupal login form, the permission endpoint, the materials
+endpoint and the member roster, with configurable latency, error rate and
+server-side session expiry. Counts every request per endpoint so the
+benchmarks can report how many upstream calls a run cost.
+
+Run on its own with ``python -m benchmarks.stub_server --port 8099``.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+LOGIN_PAGE = "<form id='user-login-form' action='/user/login'><input name='form_id' value='user_login'></form>"
+LOGGED_IN_PAGE = "<a href='/user/logout'>Log out</a>"
+
+
+class StubConfig(object):
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, session_ttl=0.0,
+                 deny_prefix="nonmember", materials=None, seed=None):
+        self.latency = latency # Mean seconds added to every response
+        self.jitter = jitter # +/- uniform noise on the latency
+        self.error_rate = error_rate # Fraction of API requests answered with 503
+        self.session_ttl = session_ttl # Seconds a login cookie stays valid server side, 0 = forever
+        self.deny_prefix = deny_prefix # Emails starting with this lack the permission
+        self.materials = materials if materials is not None else [
+            dict(label="PLA Filament", unit="100g", cost="2.00", purchase="https://example.org/buy/pla"),
+            dict(label="PETG Filament", unit="100g", cost="2.50", purchase="https://example.org/buy/petg"),
+        ]
+        self.random = random.Random(seed)
+
+
+class StubMakeHaven(object):
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or StubConfig()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._sessions = {} # cookie -> login time
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="StubMakeHaven")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] += 1
+
+    def expire_sessions(self):
+        with self._lock:
+            self._sessions.clear()
+
+    # -- Behaviour --
+    def _delay(self):
+        config = self.config
+        if config.latency or config.jitter:
+            time.sleep(max(0.0, config.latency + config.random.uniform(-config.jitter, config.jitter)))
+
+    def _failing(self):
+        return self.config.error_rate and self.config.random.random() < self.config.error_rate
+
+    def _new_session(self):
+        cookie = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[cookie] = time.monotonic()
+        return cookie
+
+    def _session_valid(self, cookie):
+        with self._lock:
+            logged_in_at = self._sessions.get(cookie)
+        if logged_in_at is None:
+            return False
+        ttl = self.config.session_ttl
+        return not ttl or time.monotonic() - logged_in_at < ttl
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, so connection pooling shows up in the numbers
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, content_type="application/json", headers=None):
+                data = body.encode("utf-8") if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _cookie(self):
+                for part in (self.headers.get("Cookie") or "").split(";"):
+                    name, _, value = part.strip().partition("=")
+                    if name == "SESS":
+                        return value
+                return None
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                stub.count("login")
+                stub._delay()
+                if stub._failing():
+                    return self._reply(503, "Service Unavailable", "text/plain")
+                cookie = stub._new_session()
+                self._reply(200, LOGGED_IN_PAGE, "text/html", {"Set-Cookie": f"SESS={cookie}; Path=/"})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = [unquote(part) for part in url.path.strip("/").split("/")]
+                if url.path.startswith("/user/login"):
+                    stub.count("login_page")
+                    return self._reply(200, LOGIN_PAGE, "text/html")
+
+                stub._delay()
+                if not stub._session_valid(self._cookie()):
+                    stub.count("expired")
+                    # Drupal sends expired sessions to the login form
+                    return self._reply(302, "", "text/html", {"Location": f"/user/login?destination={url.path}"})
+
+                if url.path.startswith("/api/v0/email/"):
+                    # Interactive checks are tagged as lookups, anything else is a usage record
+                    method = (parse_qs(url.query).get("method") or [""])[0]
+                    endpoint = "permission" if method.endswith("_lookup") else "note"
+                    stub.count(endpoint)
+                    if stub._failing():
+                        return self._reply(503, "Service Unavailable", "text/plain")
+                    email = parts[3] if len(parts) > 3 else ""
+                    if email.startswith(stub.config.deny_prefix):
+                        return self._reply(200, json.dumps([dict(access="false")]))
+                    return self._reply(200, json.dumps([dict(access="true", first_name="Bench", last_name=email.split("@")[0])]))
+
+                if url.path.startswith("/api/v0/materials/"):
+                    stub.count("materials")
+                    if stub._failing():
+                        return self._reply(503, "Service Unavailable", "text/plain")
+                    etag = '"materials-v1"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._reply(304, b"", headers={"ETag": etag})
+                    return self._reply(200, json.dumps(stub.config.materials), headers={"ETag": etag})
+
+                if url.path.startswith("/api/v0/roster/"):
+                    stub.count("roster")
+                    members = [dict(email=f"member{i}@example.org", first_name="Bench", last_name=f"member{i}") for i in range(1000)]
+                    return self._reply(200, json.dumps(members))
+
+                stub.count("other")
+                self._reply(200, LOGGED_IN_PAGE, "text/html")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the MakeHaven website API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="+/- latency noise in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests answered with 503")
+    parser.add_argument("--session-ttl", type=float, default=0.0, help="seconds before a login expires server side (0 = never)")
+    args = parser.parse_args()
+
+    stub = StubMakeHaven(StubConfig(args.latency, args.jitter, args.error_rate, args.session_ttl), args.host, args.port).start()
+    print(f"Stub MakeHaven API listening on {stub.base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Requests so far: {dict(stub.counts)}")
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
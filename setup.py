@@ -4,11 +4,14 @@ from setuptools import setup, find_packages
 setup(
     name="OctoPrint-AuthPluginTest",
     version="1.0.0",
-    packages=find_packages(), # Finds 'authplugin'
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]), # Finds 'authplugin', not the benchmarks
     install_requires=[
         "requests",
         "flask" # Still needed by SimpleApiPlugin potentially
     ],
+    extras_require={
+        "httpx": ["httpx[http2]"] # Optional HTTP/2 transport, see the http_transport setting
+    },
     entry_points={
         "octoprint.plugin": [
             "print_auth_plugin = authplugin"
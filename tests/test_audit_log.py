@@ -0,0 +1,123 @@
+# coding=utf-8
+import logging
+
+import pytest
+
+from authplugin.audit_log import AuditLog
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def audit(tmp_path):
+    logs = []
+
+    def make(job_details=None):
+        log = AuditLog(str(tmp_path / "audit.db"), logging.getLogger(__name__), job_details=job_details, clock=Clock())
+        log.start()
+        logs.append(log)
+        return log
+
+    yield make
+    for log in logs:
+        log.stop()
+
+
+def flush(log):
+    # The writer thread has written everything queued so far
+    log.stop()
+    log.start()
+
+
+def test_reauthorized_print_counts_once(audit):
+    log = audit()
+    log.record_decision("Ada@example.org", "Prusa", "print", True, job=("local", "part.gcode"), print_id="p1")
+    log.record_decision("ada@example.org", "Prusa", "print", True, job=("local", "part.gcode"), print_id="p1")
+    log.record_material("p1", "paid")
+    flush(log)
+    rows = log.decisions(email="ada@example.org")["items"]
+    assert [(row["printed"], row["material"]) for row in rows] == [(1, "paid"), (0, None)] # Newest first
+    usage = log.usage_by_member()
+    assert usage["total"] == 1
+    assert usage["items"][0]["email"] == "ada@example.org"
+    assert usage["items"][0]["prints"] == 1
+    assert usage["items"][0]["paid"] == 1
+
+
+def test_denied_and_preauthorized_not_counted(audit):
+    log = audit()
+    log.record_decision("ada@example.org", "Prusa", "print", False, message="Permission denied")
+    log.record_decision("ada@example.org", "Prusa", "preauthorize", True, job=("local", "part.gcode"))
+    flush(log)
+    assert log.count() == 2
+    assert log.usage_by_member()["items"] == []
+
+
+def test_job_details_looked_up_once_per_file(audit):
+    lookups = []
+
+    def job_details(origin, path):
+        lookups.append((origin, path))
+        return dict(filament_mm=100.0, filament_g=0.3)
+
+    log = audit(job_details)
+    log.record_decision("ada@example.org", "Prusa", "print", True, job=("local", "part.gcode"), print_id="p1")
+    log.record_decision("bob@example.org", "Prusa", "print", True, job=("local", "part.gcode"), print_id="p2")
+    flush(log)
+    assert lookups == [("local", "part.gcode")]
+    usage = log.usage_by_file()["items"]
+    assert usage[0]["file"] == "part.gcode"
+    assert usage[0]["prints"] == 2
+    assert usage[0]["filament_mm"] == pytest.approx(200.0)
+
+
+def test_pagination(audit):
+    log = audit()
+    for i in range(5):
+        log.record_decision(f"member{i}@example.org", "Prusa", "print", True, print_id=f"p{i}")
+    flush(log)
+    page = log.decisions(limit=2, offset=2)
+    assert page["total"] == 5
+    assert (page["limit"], page["offset"]) == (2, 2)
+    assert [row["email"] for row in page["items"]] == ["member2@example.org", "member1@example.org"]
+    assert log.decisions(limit=10000)["limit"] == AuditLog.MAX_PAGE_SIZE
+    assert log.decisions(limit=0, offset=-3)["limit"] == 50
+    assert log.decisions(offset=-3)["offset"] == 0
+    members = log.usage_by_member(limit=3)
+    assert members["total"] == 5
+    assert len(members["items"]) == 3
+
+
+def test_time_range(audit):
+    log = audit()
+    log.record_decision("ada@example.org", "Prusa", "print", True, print_id="p1") # ts 1001
+    log.record_decision("ada@example.org", "Prusa", "print", True, print_id="p2") # ts 1002
+    log.record_decision("ada@example.org", "Prusa", "print", True, print_id="p3") # ts 1003
+    flush(log)
+    assert log.usage_by_member(since=1002, until=1003)["items"][0]["prints"] == 1
+
+
+def test_retention_drops_oldest(audit):
+    log = audit()
+    log.configure(0) # Unlimited while filling
+    for i in range(2000):
+        log.record_decision("ada@example.org", "Prusa", "print", True, message="x" * 200, print_id=f"p{i}")
+    flush(log)
+    log.stop()
+    log.configure(128 * 1024)
+    log.start() # Checks the size when the writer starts
+    flush(log)
+    remaining = log.count()
+    assert 0 < remaining < 2000
+    newest = log.decisions(limit=1)["items"][0]
+    assert newest["print_id"] == "p1999"
+    oldest = log.decisions(limit=1, offset=remaining - 1)["items"][0]
+    assert oldest["print_id"] == f"p{2000 - remaining}"
@@ -0,0 +1,146 @@
+# coding=utf-8
+import logging
+
+import pytest
+
+from authplugin.circuit_breaker import AdaptiveTimeout, CircuitBreaker, CircuitOpenError
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def breaker():
+    clock = Clock()
+    changes = []
+    breaker = CircuitBreaker(logging.getLogger(__name__), on_change=changes.append, clock=clock)
+    breaker.configure(failure_threshold=3, reset_timeout=60)
+    return breaker, clock, changes
+
+
+def test_opens_after_threshold(breaker):
+    breaker, clock, changes = breaker
+    breaker.before_request()
+    breaker.record_failure("timeout")
+    breaker.record_failure("timeout")
+    assert breaker.snapshot()["state"] == "closed"
+    breaker.record_failure("timeout")
+    assert breaker.snapshot() == dict(state="open", failures=3, retry_in=60.0, last_error="timeout")
+    assert [change["state"] for change in changes] == ["open"]
+    clock.now += 20
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.retry_in == pytest.approx(40.0)
+
+
+def test_success_resets_failure_count(breaker):
+    breaker, clock, changes = breaker
+    breaker.record_failure("timeout")
+    breaker.record_failure("timeout")
+    breaker.record_success()
+    breaker.record_failure("timeout")
+    assert breaker.snapshot()["state"] == "closed"
+    assert changes == [] # Already closed, nothing to report
+
+
+def test_half_open_probe_closes(breaker):
+    breaker, clock, changes = breaker
+    for _ in range(3):
+        breaker.record_failure("503")
+    clock.now += 60
+    breaker.before_request() # The probe goes through
+    assert breaker.snapshot()["state"] == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request() # Everyone else keeps failing fast during the probe
+    breaker.record_success()
+    assert breaker.snapshot() == dict(state="closed", failures=0, retry_in=None, last_error=None)
+    assert [change["state"] for change in changes] == ["open", "closed"]
+    breaker.before_request()
+
+
+def test_failed_probe_reopens(breaker):
+    breaker, clock, changes = breaker
+    for _ in range(3):
+        breaker.record_failure("503")
+    clock.now += 60
+    breaker.before_request()
+    breaker.record_failure("still down")
+    snapshot = breaker.snapshot()
+    assert snapshot["state"] == "open"
+    assert snapshot["retry_in"] == pytest.approx(60.0) # A full new cool-down
+    assert [change["state"] for change in changes] == ["open", "open"]
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_stuck_probe_is_replaced(breaker):
+    breaker, clock, changes = breaker
+    for _ in range(3):
+        breaker.record_failure("503")
+    clock.now += 60
+    breaker.before_request() # Probe that never reports back
+    clock.now += 60
+    breaker.before_request() # Allowed as the next probe after a whole cool-down
+
+
+def test_configure_clamps():
+    breaker = CircuitBreaker(logging.getLogger(__name__))
+    breaker.configure(0, 0)
+    assert breaker.failure_threshold == 1
+    assert breaker.reset_timeout == 1.0
+
+
+def test_adaptive_timeout_uses_max_until_enough_samples():
+    timeout = AdaptiveTimeout()
+    timeout.configure(connect=3, read_min=2, read_max=15)
+    for _ in range(AdaptiveTimeout.MIN_SAMPLES - 1):
+        timeout.observe(0.1)
+    assert timeout.current() == (3.0, 15.0)
+
+
+def test_adaptive_timeout_clamps_to_min():
+    timeout = AdaptiveTimeout()
+    timeout.configure(connect=3, read_min=2, read_max=15)
+    for _ in range(20):
+        timeout.observe(0.1) # 3x p95 is 0.3s
+    assert timeout.read_timeout() == 2.0
+
+
+def test_adaptive_timeout_follows_p95():
+    timeout = AdaptiveTimeout()
+    timeout.configure(connect=3, read_min=2, read_max=15)
+    for seconds in [1.0] * 19 + [3.0]:
+        timeout.observe(seconds)
+    assert timeout.percentile(0.95) == 3.0
+    assert timeout.read_timeout() == pytest.approx(9.0)
+
+
+def test_adaptive_timeout_clamps_to_max():
+    timeout = AdaptiveTimeout()
+    timeout.configure(connect=3, read_min=2, read_max=15)
+    for _ in range(20):
+        timeout.observe(10.0)
+    assert timeout.read_timeout() == 15.0
+
+
+def test_adaptive_timeout_configure_bounds():
+    timeout = AdaptiveTimeout()
+    timeout.configure(connect=0, read_min=8, read_max=4)
+    assert timeout.connect == 0.5
+    assert timeout.read_min == 8.0
+    assert timeout.read_max == 8.0 # Never below read_min
+
+
+def test_adaptive_timeout_window():
+    timeout = AdaptiveTimeout(window=10)
+    for _ in range(10):
+        timeout.observe(10.0)
+    for _ in range(10):
+        timeout.observe(1.0) # Pushes the slow samples out
+    assert timeout.percentile(0.95) == 1.0
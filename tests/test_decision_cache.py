@@ -0,0 +1,85 @@
+# coding=utf-8
+import pytest
+
+from authplugin.decision_cache import DecisionCache
+
+
+GRANTED = dict(success=True, message="Authenticated")
+DENIED = dict(success=False, message="Permission denied")
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_make_key_normalizes_email():
+    assert DecisionCache.make_key(" Ada@Example.ORG ", "printer_3d", "Prusa") == ("ada@example.org", "printer_3d", "Prusa")
+
+
+def test_granted_and_denied_ttls(clock):
+    cache = DecisionCache(granted_ttl=3600, denied_ttl=300, clock=clock)
+    cache.put("granted", GRANTED)
+    cache.put("denied", DENIED)
+    clock.now = 299
+    assert cache.get("granted") == GRANTED
+    assert cache.get("denied") == DENIED
+    clock.now = 300
+    assert cache.get("denied") is None
+    assert cache.get("granted") == GRANTED
+    clock.now = 3600
+    assert cache.get("granted") is None
+    assert len(cache) == 0 # Expired entries are dropped on read
+
+
+def test_zero_ttl_is_not_cached(clock):
+    cache = DecisionCache(denied_ttl=0, clock=clock)
+    cache.put("denied", DENIED)
+    assert cache.get("denied") is None
+
+
+def test_lru_eviction(clock):
+    cache = DecisionCache(max_entries=2, clock=clock)
+    cache.put("a", GRANTED)
+    cache.put("b", GRANTED)
+    assert cache.get("a") == GRANTED # a is now the most recently used
+    cache.put("c", GRANTED)
+    assert cache.get("b") is None
+    assert cache.get("a") == GRANTED
+    assert cache.get("c") == GRANTED
+
+
+def test_shrinking_evicts_oldest(clock):
+    cache = DecisionCache(max_entries=3, clock=clock)
+    for key in "abc":
+        cache.put(key, GRANTED)
+    cache.configure(1, 3600, 300)
+    assert len(cache) == 1
+    assert cache.get("c") == GRANTED
+
+
+def test_get_returns_copy(clock):
+    cache = DecisionCache(clock=clock)
+    cache.put("a", GRANTED)
+    cache.get("a")["success"] = False
+    assert cache.get("a") == GRANTED
+
+
+def test_invalidate_member(clock):
+    cache = DecisionCache(clock=clock)
+    cache.put(DecisionCache.make_key("ada@example.org", "printer_3d", "Prusa"), GRANTED)
+    cache.put(DecisionCache.make_key("ada@example.org", "laser", "Epilog"), GRANTED)
+    cache.put(DecisionCache.make_key("bob@example.org", "printer_3d", "Prusa"), GRANTED)
+    assert cache.invalidate("ADA@example.org") == 2
+    assert len(cache) == 1
+    assert cache.invalidate() == 1
+    assert len(cache) == 0
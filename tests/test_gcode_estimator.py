@@ -0,0 +1,60 @@
+# coding=utf-8
+import logging
+import os
+
+import pytest
+
+from authplugin.gcode_estimator import FilamentEstimator, scan_extrusion
+
+
+TEST_GCODE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.gcode")
+
+
+@pytest.fixture
+def gcode(tmp_path):
+    def write(text):
+        path = tmp_path / "part.gcode"
+        path.write_text(text)
+        return str(path)
+    return write
+
+
+def test_sample_file():
+    # Primes to E3, then draws the square at E5: 5mm in total
+    assert scan_extrusion(TEST_GCODE) == {0: pytest.approx(5.0)}
+
+
+def test_absolute_with_retraction(gcode):
+    assert scan_extrusion(gcode("G1 E10\nG1 E8\nG1 E12\n")) == {0: pytest.approx(12.0)}
+
+
+def test_relative_extrusion_m83(gcode):
+    assert scan_extrusion(gcode("M83\nG1 X1 E2\nG1 E-1\nG1 X2 E3\n")) == {0: pytest.approx(4.0)}
+
+
+def test_relative_positioning_g91(gcode):
+    assert scan_extrusion(gcode("G91\nG1 E2\nG1 E2\nG90\nG92 E0\nG1 E1\n")) == {0: pytest.approx(5.0)}
+
+
+def test_g92_reset(gcode):
+    assert scan_extrusion(gcode("G1 E10\nG92 E0\nG1 E5\nG92\nG1 E1\n")) == {0: pytest.approx(16.0)}
+
+
+def test_tool_change(gcode):
+    lengths = scan_extrusion(gcode("T0\nG1 E4\nT1\nG92 E0\nG1 E7\nT0\nG1 E6\n"))
+    assert lengths == {0: pytest.approx(6.0), 1: pytest.approx(7.0)}
+
+
+def test_inches(gcode):
+    assert scan_extrusion(gcode("G20\nG1 E1\n")) == {0: pytest.approx(25.4)}
+
+
+def test_line_numbers_checksums_and_comments(gcode):
+    assert scan_extrusion(gcode("N1 G1 E5*33\nn2 g1 e7 ; comment E100\nN3 G1 E9*12 ; E50\n")) == {0: pytest.approx(9.0)}
+
+
+def test_cached_never_scans(tmp_path):
+    estimator = FilamentEstimator(str(tmp_path / "estimates.json"), logging.getLogger(__name__))
+    assert estimator.cached(TEST_GCODE) is None
+    assert estimator.estimate(TEST_GCODE) == {0: pytest.approx(5.0)}
+    assert estimator.cached(TEST_GCODE) == {0: pytest.approx(5.0)}
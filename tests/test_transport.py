@@ -0,0 +1,81 @@
+# coding=utf-8
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import authplugin.transport
+from authplugin.transport import InflightRequests
+
+
+FOLLOWERS = 3
+
+
+class WaitedFuture(Future):
+    # Lets the leader hold its request until every follower is waiting on it
+    waiting = threading.Semaphore(0)
+
+    def result(self, timeout=None):
+        self.waiting.release()
+        return super(WaitedFuture, self).result(timeout)
+
+
+@pytest.fixture
+def inflight(monkeypatch):
+    WaitedFuture.waiting = threading.Semaphore(0)
+    monkeypatch.setattr(authplugin.transport, "Future", WaitedFuture)
+    return InflightRequests()
+
+
+def _run_with_followers(inflight, call):
+    outcomes = {}
+
+    def leader_call():
+        for _ in range(FOLLOWERS):
+            assert WaitedFuture.waiting.acquire(timeout=5)
+        return call()
+
+    def follower_call():
+        raise AssertionError("follower sent its own request")
+
+    def run(name, func):
+        try:
+            outcomes[name] = inflight.run("key", func)
+        except Exception as e:
+            outcomes[name] = e
+
+    leader = threading.Thread(target=run, args=("leader", leader_call))
+    leader.start()
+    while not len(inflight):
+        leader.join(0.001)
+    followers = [threading.Thread(target=run, args=(f"follower{i}", follower_call)) for i in range(FOLLOWERS)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join(5)
+    return outcomes
+
+
+def test_single_caller(inflight):
+    assert inflight.run("a", lambda: 42) == (42, False)
+    assert len(inflight) == 0
+
+
+def test_followers_share_result(inflight):
+    outcomes = _run_with_followers(inflight, lambda: "granted")
+    assert outcomes.pop("leader") == ("granted", False)
+    assert list(outcomes.values()) == [("granted", True)] * FOLLOWERS
+    assert len(inflight) == 0
+
+
+def test_followers_get_leader_exception(inflight):
+    error = ValueError("API down")
+
+    def fail():
+        raise error
+
+    outcomes = _run_with_followers(inflight, fail)
+    assert outcomes.pop("leader") is error
+    assert list(outcomes.values()) == [error] * FOLLOWERS
+    assert len(inflight) == 0
+    assert inflight.run("key", lambda: "next") == ("next", False) # A failed request is not reused
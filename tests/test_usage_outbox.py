@@ -0,0 +1,81 @@
+# coding=utf-8
+import logging
+
+import pytest
+
+from authplugin.usage_outbox import UsageOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return UsageOutbox(str(tmp_path / "outbox.db"), logging.getLogger(__name__))
+
+
+def notes(outbox):
+    return [entry["note"] for entry in outbox.pending()]
+
+
+def test_oldest_first_and_ack(outbox):
+    first = outbox.enqueue("a@example.org", "first")
+    outbox.enqueue("b@example.org", "second", tool_name="Prusa", material_choice="paid")
+    assert notes(outbox) == ["first", "second"]
+    assert outbox.pending()[1]["tool_name"] == "Prusa"
+    outbox.ack(first)
+    assert notes(outbox) == ["second"]
+    assert outbox.count() == 1
+
+
+def test_batch_limit(outbox):
+    for i in range(5):
+        outbox.enqueue("a@example.org", f"note {i}")
+    assert [entry["note"] for entry in outbox.pending(limit=2)] == ["note 0", "note 1"]
+
+
+def test_failed_records_go_after_fresh_ones(outbox):
+    failed = outbox.enqueue("a@example.org", "failed")
+    outbox.enqueue("a@example.org", "fresh")
+    assert outbox.mark_failed(failed, "400") is False
+    assert notes(outbox) == ["fresh", "failed"]
+    assert outbox.pending()[1]["attempts"] == 1
+
+
+def test_parked_after_max_attempts(outbox):
+    rejected = outbox.enqueue("a@example.org", "rejected")
+    outbox.enqueue("a@example.org", "other")
+    assert outbox.mark_failed(rejected, "400", max_attempts=2) is False
+    assert outbox.mark_failed(rejected, "400", max_attempts=2) is True
+    assert notes(outbox) == ["other"]
+    assert outbox.count() == 1
+    assert outbox.parked_count() == 1
+
+
+def test_incomplete_records_wait(outbox):
+    waiting_material = outbox.enqueue("a@example.org", "material", awaiting_material=True)
+    waiting_estimate = outbox.enqueue("a@example.org", "Filament: N/A", awaiting_estimate=True)
+    assert notes(outbox) == []
+    outbox.set_material(waiting_material, "own_material")
+    outbox.set_note(waiting_estimate, "Filament: 5.0mm")
+    assert [(entry["note"], entry["material_choice"]) for entry in outbox.pending()] == \
+        [("material", "own_material"), ("Filament: 5.0mm", None)]
+
+
+def test_release_incomplete(outbox):
+    outbox.enqueue("a@example.org", "material", awaiting_material=True)
+    outbox.enqueue("a@example.org", "Filament: N/A", awaiting_estimate=True)
+    outbox.enqueue("a@example.org", "complete")
+    assert outbox.release_incomplete() == 2
+    assert [(entry["note"], entry["material_choice"]) for entry in outbox.pending()] == \
+        [("material", "unconfirmed"), ("Filament: N/A", None), ("complete", None)]
+
+
+def test_discard(outbox):
+    entry_id = outbox.enqueue("a@example.org", "never printed", awaiting_material=True)
+    outbox.discard(entry_id)
+    assert outbox.release_incomplete() == 0
+    assert outbox.count() == 0
+
+
+def test_survives_reopen(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    UsageOutbox(path, logging.getLogger(__name__)).enqueue("a@example.org", "kept")
+    assert notes(UsageOutbox(path, logging.getLogger(__name__))) == ["kept"]